@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- mode: python -*-
+"""
+    bench_counterparts
+    __________________
+
+    Benchmarks for loading config files, looking up counterparts, and
+    running the ``counterpart`` command, on generated configs of
+    various sizes and shapes.  Results are written as JSON, so that
+    runs on different commits can be compared::
+
+      python benchmarks/bench_counterparts.py -o before.json
+      # ... change things ...
+      python benchmarks/bench_counterparts.py -o after.json --compare before.json
+
+    :copyright: (c) 2015 by Lionel D. Hummel
+    :license: GPLv2; see LICENSE.txt for more details.
+"""
+
+import sys
+import os
+import gc
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import counterparts
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Run the command's entry point the way the console script does (and
+# the module's own __main__ block, which only calls main()).
+_CLI_CODE = "import sys, counterparts; sys.exit(counterparts.main())"
+
+
+def write_map_config(path, size, chain=2, include_paths=()):
+    """Write a config with `size` COUNTERPART_MAP options, whose values
+    go through a `chain` of %(...)s references, and a prepend_path.
+
+    """
+    lines = ["[DEFAULT]", "v0 = %(home)s/dest"]
+    for i in range(1, chain):
+        lines.append("v%d = %%(v%d)s/%d" % (i, i - 1, i))
+    lines.append("[COUNTERPART_MAP]")
+    top = "v%d" % (chain - 1)
+    for i in range(size):
+        lines.append("src/d%d/f%d.txt = %%(%s)s/d%d/f%d.txt" %
+                     (i % 1000, i, top, i % 1000, i))
+    lines.append("[COUNTERPART_DIR]")
+    lines.append("prepend_path = %%(%s)s/other" % (top))
+    if include_paths:
+        lines.append("[INCLUDE]")
+        lines.append("paths = " + "\n      ".join(include_paths))
+    with open(path, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+
+
+def write_include_tree(directory, depth, width, size):
+    """Write a tree of config files, each including `width` others, to
+    `depth` levels, with `size` options spread over all of them.
+
+    :return: The path of the root file.
+
+    """
+    files = [[]]
+    for level in range(depth):
+        files.append(["inc-%d-%d" % (level, i)
+                      for i in range(width ** (level + 1))])
+    count = sum(len(level) for level in files) + 1
+    per_file = max(1, size // count)
+    root = os.path.join(directory, "root")
+    write_map_config(root, per_file, include_paths=files[1][:width])
+    for level in range(1, depth + 1):
+        for i, name in enumerate(files[level]):
+            children = (files[level + 1][i * width:(i + 1) * width]
+                        if level < depth else [])
+            with open(os.path.join(directory, name), "w") as fp:
+                fp.write("[COUNTERPART_MAP]\n")
+                for j in range(per_file):
+                    fp.write("%s/%d = %s/%d\n" % (name, j, name, j))
+                if children:
+                    fp.write("[INCLUDE]\npaths = %s\n" %
+                             ("\n      ".join(children)))
+    return root
+
+
+def best_of(repeat, function):
+    """:return: The least time, in seconds, of `repeat` calls."""
+    times = []
+    for __ in range(repeat):
+        gc.collect()
+        start = _clock()
+        function()
+        times.append(_clock() - start)
+    return min(times)
+
+
+def peak_memory(function):
+    """:return: The most memory, in bytes, allocated while `function`
+        runs (None if tracemalloc is not available).
+
+    """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Bench:
+
+    def __init__(self, options, work_dir):
+
+        self.options = options
+        self.work_dir = work_dir
+        self.results = []
+
+    def record(self, benchmark, **fields):
+
+        fields["benchmark"] = benchmark
+        self.results.append(fields)
+        if self.options.verbose:
+            sys.stderr.write("%s\n" % (json.dumps(fields, sort_keys=True)))
+
+    def load(self, name, config_file, **fields):
+
+        repeat = self.options.repeat
+
+        def parse():
+            return counterparts.ConfigFromFile(
+                config_file, [], skip_file_read=[self.home_rc_file])
+
+        # shared=False throughout: a load must not come from the
+        # registry (see counterparts.MappingRegistry).
+        def load_frozen():
+            return counterparts.get_counterpart_mapping(config_file, True,
+                                                        frozen=True,
+                                                        shared=False)
+
+        self.record("load", config=name, mode="parse",
+                    seconds=best_of(repeat, parse),
+                    peak_bytes=peak_memory(parse), **fields)
+        self.record("load", config=name, mode="frozen",
+                    seconds=best_of(repeat, load_frozen),
+                    peak_bytes=peak_memory(load_frozen), **fields)
+        cache_dir = os.path.join(self.work_dir, "cache")
+        counterparts.get_counterpart_mapping(config_file, True,
+                                             cache=cache_dir, shared=False)
+        self.record("load", config=name, mode="cached",
+                    seconds=best_of(repeat, lambda: (
+                        counterparts.get_counterpart_mapping(
+                            config_file, True, cache=cache_dir,
+                            shared=False))), **fields)
+
+    @property
+    def home_rc_file(self):
+
+        return os.path.join(os.getenv("HOME"), ".counterc")
+
+    def lookups(self, size, config_file):
+
+        count = min(self.options.lookups, size)
+        rng = random.Random(size)
+        keys = ["src/d%d/f%d.txt" % (i % 1000, i)
+                for i in rng.sample(range(size), count)]
+        cases = [("hit", keys),
+                 ("prepend_path", ["miss/%d" % (i) for i in range(count)])]
+        index_path = os.path.join(self.work_dir, "map-%d.idx" % (size))
+        mappings = [
+            ("plain", counterparts.get_counterpart_mapping(config_file,
+                                                           True)),
+            ("frozen", counterparts.get_counterpart_mapping(config_file,
+                                                            True,
+                                                            frozen=True))]
+        counterparts.compile_counterpart_index(mappings[1][1], index_path)
+        mappings.append(("indexed",
+                         counterparts.get_counterpart_mapping(index_path)))
+        for mode, mapping in mappings:
+            for case, strings in cases:
+                def get_each():
+                    get = mapping.get
+                    for known in strings:
+                        get(known)
+
+                seconds = best_of(self.options.repeat, get_each)
+                self.record("lookup", size=size, mode=mode, case=case,
+                            api="get", lookups=count, seconds=seconds,
+                            lookups_per_second=count / seconds)
+                seconds = best_of(self.options.repeat,
+                                  lambda: mapping.map_many(strings))
+                self.record("lookup", size=size, mode=mode, case=case,
+                            api="map_many", lookups=count, seconds=seconds,
+                            lookups_per_second=count / seconds)
+        mappings[2][1].close()
+        # Without a COUNTERPART_DIR section, misses really miss:
+        miss_config = os.path.join(self.work_dir, "conf-miss-%d" % (size))
+        with open(config_file) as fp_in, open(miss_config, "w") as fp_out:
+            fp_out.write(fp_in.read().split("[COUNTERPART_DIR]")[0])
+        mapping = counterparts.get_counterpart_mapping(miss_config, True,
+                                                       frozen=True)
+        strings = ["miss/%d" % (i) for i in range(count)]
+        seconds = best_of(self.options.repeat,
+                          lambda: [mapping.get(known) for known in strings])
+        self.record("lookup", size=size, mode="frozen", case="miss",
+                    api="get", lookups=count, seconds=seconds,
+                    lookups_per_second=count / seconds)
+
+    def cli(self, size, config_file):
+
+        input_path = os.path.join(self.work_dir, "input-%d" % (size))
+        count = min(self.options.lookups, size)
+        with open(input_path, "w") as fp:
+            for i in range(count):
+                fp.write("src/d%d/f%d.txt\n" % (i % 1000, i))
+        env = dict(os.environ, HOME=self.work_dir,
+                   XDG_CACHE_HOME=os.path.join(self.work_dir, "cli-cache"),
+                   COUNTERPART_SOCKET=os.path.join(self.work_dir, "none"))
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(counterparts.__file__))] +
+            [p for p in [os.getenv("PYTHONPATH")] if p])
+        base = [sys.executable, "-c", _CLI_CODE, "-c", config_file]
+        runs = [("single", "no-cache", ["--no-cache", "src/d0/f0.txt"]),
+                ("single", "cached", ["src/d0/f0.txt"]),
+                ("bulk", "no-cache", ["--no-cache", "-i", input_path]),
+                ("bulk", "cached", ["-i", input_path])]
+        with open(os.devnull, "w") as devnull:
+            for case, mode, args in runs:
+                def run():
+                    subprocess.check_call(base + args, env=env,
+                                          stdout=devnull)
+
+                run()       # warm the cache and the OS's file cache
+                self.record("cli", size=size, case=case, mode=mode,
+                            strings=count if case == "bulk" else 1,
+                            seconds=best_of(self.options.repeat, run))
+
+    def run(self):
+
+        for size in self.options.sizes:
+            config_file = os.path.join(self.work_dir, "conf-%d" % (size))
+            write_map_config(config_file, size)
+            self.load("flat", config_file, size=size)
+            self.lookups(size, config_file)
+            if not self.options.no_cli:
+                self.cli(size, config_file)
+        for chain in self.options.chains:
+            config_file = os.path.join(self.work_dir, "conf-chain-%d" %
+                                       (chain))
+            write_map_config(config_file, 1000, chain=chain)
+            self.load("chain", config_file, size=1000, chain=chain)
+        for depth, width in self.options.trees:
+            tree_dir = tempfile.mkdtemp(dir=self.work_dir)
+            root = write_include_tree(tree_dir, depth, width, 10000)
+            self.load("include-tree", root, size=10000, depth=depth,
+                      width=width)
+
+
+def git_commit():
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_results, new_results):
+    """:return: Lines reporting each benchmark's time in `new_results`
+        relative to the same one in `old_results`.
+
+    """
+    def key(result):
+        return json.dumps(dict((k, v) for k, v in result.items()
+                               if k not in ("seconds", "peak_bytes",
+                                            "lookups_per_second")),
+                          sort_keys=True)
+
+    old_seconds = dict((key(r), r["seconds"]) for r in old_results)
+    lines = []
+    for result in new_results:
+        old = old_seconds.get(key(result))
+        if old:
+            lines.append("%6.2fx  %s" % (result["seconds"] / old,
+                                         key(result)))
+    return lines
+
+
+def int_list(text):
+
+    return [int(float(n)) for n in text.split(",") if n]
+
+
+def main(argv=sys.argv):
+
+    parser = argparse.ArgumentParser(prog="bench_counterparts")
+    parser.add_argument("-o", "--output", default="-",
+                        help="Where to write the JSON results (default: "
+                        "stdout).")
+    parser.add_argument("--sizes", type=int_list,
+                        default=[100, 1000, 10000, 100000],
+                        help="COUNTERPART_MAP sizes, comma-separated "
+                        "(e.g. 1e2,1e6).")
+    parser.add_argument("--chains", type=int_list, default=[1, 5, 9],
+                        help="Lengths of %%(...)s reference chains.")
+    parser.add_argument("--trees", default="1x50,6x2,3x8",
+                        help="INCLUDE trees, as DEPTHxWIDTH,...")
+    parser.add_argument("--lookups", type=int, default=10000,
+                        help="Lookups per throughput measurement.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Times to run each measurement; the best "
+                        "time is kept.")
+    parser.add_argument("--no-cli", action="store_true",
+                        help="Skip timing the counterpart command.")
+    parser.add_argument("--compare", default=None, metavar="OLD_JSON",
+                        help="Report times relative to an earlier run.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print each result to stderr as it is made.")
+    options = parser.parse_args(argv[1:])
+    options.trees = [tuple(int(n) for n in tree.split("x"))
+                     for tree in options.trees.split(",") if tree]
+    work_dir = tempfile.mkdtemp(prefix="bench-counterparts-")
+    try:
+        bench = Bench(options, work_dir)
+        bench.run()
+    finally:
+        shutil.rmtree(work_dir)
+    report = {"counterparts_version": counterparts.__version__,
+              "commit": git_commit(),
+              "python": sys.version.split()[0],
+              "platform": sys.platform,
+              "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "results": bench.results}
+    text = json.dumps(report, indent=1, sort_keys=True) + "\n"
+    if options.output == "-":
+        sys.stdout.write(text)
+    else:
+        with open(options.output, "w") as fp:
+            fp.write(text)
+    if options.compare:
+        with open(options.compare) as fp:
+            old = json.load(fp)
+        sys.stderr.write("time relative to %s:\n" % (old.get("commit") or
+                                                       options.compare))
+        for line in compare(old["results"], bench.results):
+            sys.stderr.write(line + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,14 +13,23 @@
 """
 
 import sys
+import io
 import os
-import argparse
+import re
+import stat
+import threading
+import time
+import json
+import mmap
+import struct
+import zlib
+import fnmatch
 import logging
-import logging.config
 
-import platform
-py_major_str, __, __ = platform.python_version_tuple()
-if int(py_major_str) >= 3:
+# Modules needed only by some commands (argparse, socket,
+# logging.config, ...) are imported where they are used, so that a
+# plain lookup does not pay to import them.
+if sys.version_info[0] >= 3:
     import configparser as config_parser
     ConfigParser = config_parser.ConfigParser
 else:
@@ -43,12 +52,541 @@ class FileNotFound(IOError):
     pass
 
 
+class AmbiguousCounterpart(KeyError):
+    """Several strings map to the counterpart that was looked up."""
+
+
+class NoSuchProfile(KeyError):
+    """No sections are named for the profile that was asked for."""
+
+
+_MISSING = object()
+
+_INTERPOLATION_REF = re.compile(r"%\(([^)]+)\)s")
+
+
+class _SectionResolver:
+    """Memoized evaluation of one section's ``%(name)s`` interpolation
+    graph, following the same rules as ConfigParser's interpolation.
+
+    Each option is expanded at most once, however many other options
+    refer to it.  An option that refers back to itself, directly or
+    through others, is reported the way ConfigParser reports it:  as
+    an InterpolationDepthError.
+
+    """
+    def __init__(self, section, raw_options):
+
+        self._section = section
+        self._raw = raw_options
+        self._resolved = {}
+        self._in_progress = set()
+
+    def resolve(self, option):
+
+        value = self._resolved.get(option, _MISSING)
+        if value is not _MISSING:
+            return value
+        raw = self._raw[option]
+        if raw is None or "%" not in raw:
+            value = raw
+        else:
+            if option in self._in_progress:
+                raise config_parser.InterpolationDepthError(option,
+                                                            self._section,
+                                                            raw)
+            self._in_progress.add(option)
+            try:
+                value = self._interpolate(option, raw)
+            finally:
+                self._in_progress.discard(option)
+        self._resolved[option] = value
+        return value
+
+    def _interpolate(self, option, rest):
+
+        raw = rest
+        accum = []
+        while rest:
+            p = rest.find("%")
+            if p < 0:
+                accum.append(rest)
+                break
+            if p > 0:
+                accum.append(rest[:p])
+                rest = rest[p:]
+            c = rest[1:2]
+            if c == "%":
+                accum.append("%")
+                rest = rest[2:]
+            elif c == "(":
+                m = _INTERPOLATION_REF.match(rest)
+                if m is None:
+                    raise config_parser.InterpolationSyntaxError(
+                        option, self._section,
+                        "bad interpolation variable reference %r" % (rest))
+                var = m.group(1).lower()
+                rest = rest[m.end():]
+                if var not in self._raw:
+                    raise config_parser.InterpolationMissingOptionError(
+                        option, self._section, raw, var)
+                accum.append(self.resolve(var))
+            else:
+                raise config_parser.InterpolationSyntaxError(
+                    option, self._section,
+                    "'%%' must be followed by '%%' or '(', " +
+                    "found: %r" % (rest))
+        return "".join(accum)
+
+
+def _raw_sections(parser):
+    """Copy the raw (uninterpolated) options out of a ConfigParser.  The
+    DEFAULT section is kept apart from the sections that ConfigParser
+    would otherwise merge it into.
+
+    :param parser: A loaded ConfigParser, e.g. ConfigFromFile._parser
+    :return: dict of section name -> dict of option -> raw value
+
+    """
+    sections = {config_parser.DEFAULTSECT: dict(parser.defaults())}
+    for section in parser.sections():
+        options = dict(parser._sections[section])
+        options.pop("__name__", None)   # Python 2 keeps it here
+        sections[section] = options
+    return sections
+
+
+def _resolve_section(sections, section, own_only=False):
+    """Interpolate every option visible in `section` (its own plus those
+    inherited from DEFAULT), as ConfigParser.get would.
+
+    :param sections: Raw options, as returned by _raw_sections()
+    :param section: Name of the section to resolve.
+    :param own_only: If True, leave out the options that `section` only
+        inherits from DEFAULT (though they are still available to be
+        interpolated into its own).
+    :return: (dict of option -> value, or None if there is no such
+        section; dict of option -> the InterpolationError it raised)
+
+    """
+    options = sections.get(section)
+    if options is None:
+        return None, {}
+    raw = dict(sections.get(config_parser.DEFAULTSECT, {}))
+    raw.update(options)
+    resolver = _SectionResolver(section, raw)
+    resolved = {}
+    errors = {}
+    for option in (options if own_only else raw):
+        try:
+            resolved[option] = resolver.resolve(option)
+        except config_parser.InterpolationError as exc:
+            errors[option] = exc
+    return resolved, errors
+
+
+def _profile_section(section, profile):
+    """:return: The name of `section` (e.g. COUNTERPART_MAP) in the
+        named profile.
+
+    """
+    return "%s:%s" % (section, profile)
+
+
+def _profile_names(sections):
+    """:return: Sorted list of the profiles named by any of `sections`
+        (section names).
+
+    """
+    kinds = set(getattr(CounterpartMapping, attr)
+                for attr in CounterpartMapping._section_attrs)
+    names = set()
+    for section in sections:
+        kind, sep, name = section.partition(":")
+        if sep and name and kind in kinds:
+            names.add(name)
+    return sorted(names)
+
+
+def _chunked(iterable, size):
+    """Yield lists of up to `size` consecutive items from `iterable`."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Bytes to and from file names; any bytes, not just valid UTF-8, come
+# back out as they went in.  (Python 2 has bytes for names already.)
+_fsdecode = getattr(os, "fsdecode", lambda name: name)
+_fsencode = getattr(os, "fsencode", lambda name: name)
+
+
+def _format_seconds(seconds):
+
+    for unit, scale in [("s", 1), ("ms", 1e3), ("us", 1e6)]:
+        if seconds * scale >= 1:
+            break
+    return "%g%s" % (seconds * scale, unit)
+
+
+class CounterpartStats:
+    """Counts and timings for loading a mapping and looking strings up
+    in it, for finding out where the time goes.
+
+    Pass one as the `tracer` of get_counterpart_mapping() (or of a
+    mapping's set_tracer()).  Any other object with the same three
+    methods can be passed instead, to record these events some other
+    way.  Without a tracer, none of this costs anything.
+
+    """
+    # Upper bounds, in seconds, of the lookup latency histogram's bins.
+    latency_bins = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2)
+
+    def __init__(self):
+
+        self.files = []             # (path, seconds, include depth)
+        self.phases = {}            # phase name -> seconds
+        self.hits = {}              # section -> lookups it answered
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.histogram = [0] * (len(self.latency_bins) + 1)
+
+    def file_read(self, path, seconds, depth):
+        """Called for each config file read; INCLUDEs have `depth` > 0."""
+        self.files.append((path, seconds, depth))
+
+    def phase(self, name, seconds):
+        """Called when a stage of loading (e.g. "parse") is done."""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def lookup(self, known, section, seconds):
+        """Called after each lookup, with the section that answered it,
+        or None for a miss.
+
+        """
+        if section is None:
+            self.misses += 1
+        else:
+            self.hits[section] = self.hits.get(section, 0) + 1
+        self.lookup_seconds += seconds
+        for i, bound in enumerate(self.latency_bins):
+            if seconds < bound:
+                break
+        else:
+            i = len(self.latency_bins)
+        self.histogram[i] += 1
+
+    def summary(self):
+        """:return: The statistics gathered so far, as readable text."""
+        lines = []
+        for name in sorted(self.phases):
+            lines.append("%-8s %10.3f ms" % (name, self.phases[name] * 1e3))
+        for path, seconds, depth in self.files:
+            lines.append("read     %10.3f ms  %s%s" %
+                         (seconds * 1e3, "  " * depth, path))
+        if self.files:
+            lines.append("include depth: %d" %
+                         max(depth for __, __, depth in self.files))
+        lookups = sum(self.hits.values()) + self.misses
+        lines.append("lookups: %d (%.3f ms)" %
+                     (lookups, self.lookup_seconds * 1e3))
+        for section in sorted(self.hits):
+            kind = ("fallback" if section.partition(":")[0] ==
+                    CounterpartMapping.dir_section else "hit")
+            lines.append("  %-8s %-20s %d" % (kind, section,
+                                              self.hits[section]))
+        lines.append("  %-8s %-20s %d" % ("miss", "", self.misses))
+        if lookups:
+            labels = ["< %s" % (_format_seconds(bound))
+                      for bound in self.latency_bins]
+            labels.append(">= %s" % (_format_seconds(self.latency_bins[-1])))
+            for label, count in zip(labels, self.histogram):
+                lines.append("  %-8s %d" % (label, count))
+        return "\n".join(lines) + "\n"
+
+
+class _PrefixTrie:
+    """Path-component trie of "source prefix -> destination prefix" rules.
+    Matching a path costs one dict probe per component of the path, no
+    matter how many rules there are, and the longest matching prefix
+    wins.  Components are compared case-insensitively, like option
+    names, but the unmatched remainder of a path keeps its case.
+
+    """
+    def __init__(self, rules):
+
+        self.rules = rules
+        self._root = {}
+        for prefix, destination in rules.items():
+            node = self._root
+            for component in self._components(prefix):
+                node = node.setdefault(component.lower(), {})
+            node[None] = destination
+
+    @staticmethod
+    def _components(path):
+
+        components = os.path.normpath(path).split(os.sep)
+        if not components[-1]:       # the root directory itself
+            components.pop()
+        return components
+
+    def match(self, path):
+        """:return: The rewritten path, or _MISSING if no rule applies."""
+        node = self._root
+        if not node or not path:
+            return _MISSING
+        components = self._components(path)
+        destination = _MISSING
+        for depth, component in enumerate(components):
+            node = node.get(component.lower())
+            if node is None:
+                break
+            if None in node:
+                destination, matched = node[None], depth + 1
+        if destination is _MISSING or matched == len(components):
+            return destination
+        return os.path.join(destination, *components[matched:])
+
+
+class _PathNormalizer:
+    """Does what os.path.relpath(path) does, for many paths, much faster:
+    the working directory `cwd` is looked up once, not once per path;
+    paths are normalized with string operations alone; relative paths
+    already in normal form are returned as they are; and each
+    directory's relative path is worked out once and remembered.
+
+    """
+    _posix = os.sep == "/" and os.altsep is None
+
+    def __init__(self, cwd=None, cache_size=1 << 14):
+
+        self.cwd = os.path.abspath(cwd) if cwd else os.getcwd()
+        self._cwd_list = [x for x in self.cwd.split(os.sep) if x]
+        self._cache_size = cache_size
+        self._dirs = {}
+        if not self._posix:
+            self.relpath = lambda path: os.path.relpath(
+                os.path.join(self.cwd, path), self.cwd)
+
+    def relpath(self, path):
+        """:return: os.path.relpath(path), relative to `cwd`."""
+        if not path:
+            raise ValueError("no path specified")
+        if path[0] != "/":
+            bounded = "/%s/" % (path)
+            if ("/./" not in bounded and "/../" not in bounded and
+                    "//" not in bounded):
+                return path
+        head, sep, tail = path.rpartition("/")
+        if not sep or tail in ("", ".", ".."):
+            return self._relpath(path)
+        rel_head = self._dirs.get(head)
+        if rel_head is None:
+            rel_head = self._relpath(head or "/")
+            if len(self._dirs) >= self._cache_size:
+                self._dirs.clear()
+            self._dirs[head] = rel_head
+        if rel_head == ".":
+            return tail
+        if rel_head == ".." or rel_head.endswith("/.."):
+            # `head` is above cwd, which `path` might be on the way to.
+            return self._relpath(path)
+        return rel_head + "/" + tail
+
+    def _relpath(self, path):
+
+        if path[0] != "/":
+            path = self.cwd + "/" + path
+        path_list = [x for x in os.path.normpath(path).split("/") if x]
+        start_list = self._cwd_list
+        common = 0
+        for start, component in zip(start_list, path_list):
+            if start != component:
+                break
+            common += 1
+        rel_list = ([".."] * (len(start_list) - common) +
+                    path_list[common:])
+        return "/".join(rel_list) if rel_list else "."
+
+
+class _LRUCache:
+    """A dict that keeps only the `size` most recently used entries."""
+
+    def __init__(self, size):
+
+        import collections
+        self._size = size
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+
+        self._data[key] = value
+        if len(self._data) > self._size:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:    # emptied by another thread meanwhile
+                pass
+
+    def pop(self, key, default=None):
+
+        return self._data.pop(key, default)
+
+    def items(self):
+
+        return list(self._data.items())
+
+    def clear(self):
+
+        self._data.clear()
+
+    def __len__(self):
+
+        return len(self._data)
+
+
+def _glob_to_regex(glob):
+    """Translate a glob into a regular expression in which each `*` and
+    `?` is a group, so that replacements can refer to what they matched
+    as \\1, \\2, etc.  As with fnmatch, `*` matches across "/".
+
+    """
+    parts = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        i += 1
+        if c == "*":
+            parts.append("(.*)")
+        elif c == "?":
+            parts.append("(.)")
+        elif c == "[" and "]" in glob[i + 1:]:
+            end = glob.index("]", i + 1)
+            members = glob[i:end].replace("\\", "\\\\")
+            if members.startswith("!"):
+                members = "^" + members[1:]
+            parts.append("[%s]" % (members))
+            i = end + 1
+        else:
+            parts.append(re.escape(c))
+    return "".join(parts)
+
+
+_rule_arrow = re.compile(r"\s+->(?:\s+|\Z)")
+
+
+def _split_rule(section, name, value):
+    """Split the value of a COUNTERPART_PATTERN or COUNTERPART_GLOB
+    option, "PATTERN -> TEMPLATE".  The pattern is kept in the value,
+    not the option name, so that ConfigParser neither lowercases it nor
+    cuts it short at a ":" or "=".
+
+    :return: [pattern, template]
+    :raise ValueError: if `value` is not of that form.
+
+    """
+    parts = _rule_arrow.split(value, 1) if value else []
+    if len(parts) != 2 or not parts[0]:
+        raise ValueError("In [%s] %s: expected PATTERN -> TEMPLATE, "
+                         "not %r" % (section, name, value))
+    return parts
+
+
+class _PatternMatcher:
+    """Pattern rules, each a regular expression that must match the
+    whole input and a replacement template for match.expand().  The
+    rules are compiled into a single alternation, so finding the first
+    rule that matches takes one scan however many rules there are.
+    Results, misses included, are kept in an LRU cache.
+
+    A rule that the alternation would break (one with backreferences,
+    which refer to groups by number, named groups, which may clash,
+    or inline flags) is matched on its own instead, in its turn.
+
+    Like COUNTERPART_MAP options, patterns match case-insensitively.
+
+    """
+    cache_size = 4096
+    _stands_alone = re.compile(r"\\[1-9]|\\g|\(\?P?[=<(]|\(\?[aiLmsux]")
+
+    def __init__(self, rules):
+        """:param rules: list of [regex, template] in order of precedence."""
+        self.rules = rules
+        self._cache = _LRUCache(self.cache_size)
+        # Each segment is (regex, {group: (rule regex, template)}, None)
+        # for a run of rules combined into one regex, or (rule regex,
+        # None, template) for a rule matched on its own.
+        self._segments = []
+        alternatives = []
+        rule_at_group = {}
+        group = 1
+        for regex, template in rules:
+            compiled = re.compile("(?:%s)\\Z" % (regex), re.IGNORECASE)
+            if compiled.groupindex or self._stands_alone.search(regex):
+                self._add_combined(alternatives, rule_at_group)
+                alternatives, rule_at_group, group = [], {}, 1
+                self._segments.append((compiled, None, template))
+                continue
+            rule_at_group[group] = (compiled, template)
+            alternatives.append("(%s)\\Z" % (regex))
+            group += 1 + compiled.groups
+        self._add_combined(alternatives, rule_at_group)
+
+    def _add_combined(self, alternatives, rule_at_group):
+
+        if alternatives:
+            self._segments.append((re.compile("|".join(alternatives),
+                                              re.IGNORECASE),
+                                   rule_at_group, None))
+
+    def match(self, known):
+        """:return: The expanded template of the first rule that matches,
+            or _MISSING if none does.
+
+        """
+        if not self._segments:
+            return _MISSING
+        counterpart = self._cache.get(known, None)
+        if counterpart is None:
+            counterpart = _MISSING
+            for regex, rule_at_group, template in self._segments:
+                m = regex.match(known)
+                if m is None:
+                    continue
+                if rule_at_group is None:
+                    counterpart = m.expand(template)
+                else:
+                    compiled, template = rule_at_group[m.lastindex]
+                    counterpart = compiled.match(known).expand(template)
+                break
+            self._cache.put(known, counterpart)
+        return counterpart
+
+
 class CounterpartMapping:
     """This class carries the pieces needed to perform mappings.
 
     Sections represent groups that enable this mapping to apply
-    different rules depending on attributes of the input.  The two
-    sections here are COUNTERPART_MAP and COUNTERPART_DIR.
+    different rules depending on attributes of the input.  The
+    sections here are COUNTERPART_MAP, COUNTERPART_PATTERN (with
+    COUNTERPART_GLOB), COUNTERPART_PREFIX and COUNTERPART_DIR,
+    consulted in that order.
 
     CounterpartMapping is much like a collections.Mapping, but it does
     not support the __iter__ and __len__ methods specified for that
@@ -57,55 +595,902 @@ class CounterpartMapping:
     in the config.
 
     """
-    def __init__(self, map_config):
+    map_section = "COUNTERPART_MAP"
+    pattern_section = "COUNTERPART_PATTERN"
+    glob_section = "COUNTERPART_GLOB"
+    prefix_section = "COUNTERPART_PREFIX"
+    dir_section = "COUNTERPART_DIR"
+    _section_attrs = ["map_section", "pattern_section", "glob_section",
+                      "prefix_section", "dir_section"]
+    profile_name = None
+    tracer = None
+    _inverse = None
+    _path_normalizer = None
+    _profiles = None
 
+    def __init__(self, map_config, bulk_table=None, profile=None):
+        """:param map_config: ConfigParser holding the config.
+        :param bulk_table: dict of further COUNTERPART_MAP entries, by
+            string (case matters), from bulk sources (see
+            ConfigFromFile); COUNTERPART_MAP options take precedence
+            over them.
+        :param profile: Name of the profile to use, if not the unnamed
+            sections (see profile()).
+
+        """
         logger.debug("NEW: CounterpartMapping w/%s", map_config)
         self._map_config = map_config
+        self._bulk_table = bulk_table
+        self._use_profile(profile)
+        self._prefix_trie = None
+        self._pattern_matcher = None
+        self.source_files = []
 
     def __getitem__(self, known):
         """If the counterpart is named explicitly in COUNTERPART_MAP, return
-        it.  When `prepend_path` is given in the COUNTERPART_DIR
-        section, it is prepended to all input that lacks an explicitly
-        named counterpart in COUNTERPART_MAP.
+        it.  Otherwise, the first rule in COUNTERPART_PATTERN (regular
+        expressions) or COUNTERPART_GLOB (globs) to match all of `known`
+        gives the counterpart, with \\1 etc. in its template replaced by
+        what the pattern's groups matched.  Otherwise, if a path prefix
+        of `known` is an option in COUNTERPART_PREFIX, the longest such
+        prefix is replaced by its value.  When `prepend_path` is given
+        in the COUNTERPART_DIR section, it is prepended to all input
+        that lacks a counterpart by any of those means.
+
+        """
+        counterpart = self._lookup(known)
+        if counterpart is _MISSING:
+            raise KeyError("Mapping not found in %s: " % (self.map_section) +
+                           "%s" % (known))
+        return counterpart
+
+    def get(self, known, default=None):
+        """Like __getitem__, but returns `default` instead of raising
+        KeyError when `known` has no counterpart.
+
+        """
+        counterpart = self._lookup(known)
+        return default if counterpart is _MISSING else counterpart
+
+    def map_many(self, strings, default=None, cwd=None):
+        """Look up a batch of strings at once.  Repeated strings are only
+        looked up once, and misses do not raise KeyError.
+
+        :param strings: Iterable of strings to look up.
+        :param default: Result for each string without a counterpart.
+        :param cwd: Directory that relative paths are relative to, if not
+            the current working directory.
+        :return: list of counterparts, in the order of `strings`.
+
+        """
+        strings = list(strings)
+        lookup = self._lookup
+        relpath = self._normalizer(cwd).relpath
+        found = dict((known, lookup(known, relpath))
+                     for known in set(strings))
+        return [default if counterpart is _MISSING else counterpart
+                for counterpart in [found[known] for known in strings]]
+
+    def _normalizer(self, cwd):
+        """:return: _PathNormalizer for `cwd` (default: the current working
+            directory), kept from one batch to the next.
+
+        """
+        cwd = os.path.abspath(cwd) if cwd else os.getcwd()
+        normalizer = self._path_normalizer
+        if normalizer is None or normalizer.cwd != cwd:
+            normalizer = self._path_normalizer = _PathNormalizer(cwd)
+        return normalizer
+
+    def imap_many(self, strings, default=None, chunk_size=4096):
+        """Generator version of map_many; `strings` is consumed
+        `chunk_size` at a time, so it may be arbitrarily long.
 
         """
+        for chunk in _chunked(strings, chunk_size):
+            for counterpart in self.map_many(chunk, default):
+                yield counterpart
+
+    def freeze(self):
+        """Resolve the whole mapping once, up front.
+
+        :return: FrozenCounterpartMapping with the same contents.
+
+        """
+        frozen = FrozenCounterpartMapping(_raw_sections(self._map_config),
+                                          self._bulk_table, self.profile_name)
+        frozen.source_files = self.source_files
+        if self.tracer is not None:
+            frozen.set_tracer(self.tracer)
+        return frozen
+
+    def inverse(self):
+        """:return: InverseCounterpartMapping for this mapping, made the
+            first time it is asked for.
+
+        """
+        if self._inverse is None:
+            self._inverse = InverseCounterpartMapping(self)
+        return self._inverse
+
+    def profile(self, name):
+        """A profile is a mapping of its own, kept in the same config
+        files:  profile "prod" is made of the sections
+        COUNTERPART_MAP:prod, COUNTERPART_PATTERN:prod, COUNTERPART_GLOB:prod,
+        COUNTERPART_PREFIX:prod and COUNTERPART_DIR:prod, in place of
+        the unnamed ones.  (Bulk sources belong to the unnamed sections
+        alone.)  Each profile's sections are resolved only when it is
+        first asked for.
+
+        :param name: Name of the profile, or None for the unnamed
+            sections.
+        :return: Mapping of the same kind as this one, for the profile.
+        :raise NoSuchProfile: if there are no sections for that profile.
+
+        """
+        if self._profiles is None:
+            self._profiles = {self.profile_name: self}
+        name = name or None
+        mapping = self._profiles.get(name)
+        if mapping is None:
+            self._check_profile(name)
+            mapping = self._new_profile(name)
+            mapping.source_files = self.source_files
+            mapping._profiles = self._profiles
+            if self.tracer is not None:
+                mapping.set_tracer(self.tracer)
+            self._profiles[name] = mapping
+        return mapping
+
+    def profiles(self):
+        """:return: Sorted list of the names of the profiles there are
+            sections for.
+
+        """
+        return _profile_names(self._map_config.sections())
+
+    def _new_profile(self, name):
+
+        return CounterpartMapping(self._map_config, self._bulk_table, name)
+
+    def _check_profile(self, name):
+        """:raise NoSuchProfile: unless `name` is None or a profile there
+            are sections for.
+
+        """
+        if name is not None and name not in self.profiles():
+            raise NoSuchProfile("No such profile: %s" % (name))
+
+    def _use_profile(self, profile):
+        """Look in the sections of `profile` (if any) from now on.
+
+        :raise NoSuchProfile: if there are no sections for it.
+
+        """
+        if not profile:
+            self._bulk = self._bulk_table or {}
+            return
+        self._check_profile(profile)
+        self._bulk = {}
+        self.profile_name = profile
+        for attr in self._section_attrs:
+            setattr(self, attr, _profile_section(
+                getattr(CounterpartMapping, attr), profile))
+
+    def _copy(self):
+        """:return: A mapping of the same kind sharing this one's parsed
+            config and rules, which are never changed once made, but
+            with its own tracer, profiles, inverse and path normalizer.
+
+        """
+        mapping = object.__new__(type(self))
+        mapping.__dict__.update(self.__dict__)
+        for attr in ["tracer", "_lookup", "_inverse", "_path_normalizer",
+                     "_profiles"]:
+            mapping.__dict__.pop(attr, None)
+        return mapping
+
+    def set_tracer(self, tracer):
+        """Report each lookup to `tracer` (see CounterpartStats), or stop
+        reporting if it is None.
+
+        """
+        self.tracer = tracer
+        if tracer is None:
+            self.__dict__.pop("_lookup", None)
+        else:
+            self._lookup = self._traced_lookup
+
+    def _traced_lookup(self, known, relpath=os.path.relpath):
+
+        start = _clock()
+        section = None
+        for section, get in [(self.map_section, self._map_get),
+                             (self.pattern_section, self._pattern_get),
+                             (self.prefix_section, self._prefix_get)]:
+            counterpart = get(known)
+            if counterpart is not _MISSING:
+                break
+        else:
+            section = self.dir_section
+            counterpart = self._dir_get(known, relpath)
+            if counterpart is _MISSING:
+                section = None
+        self.tracer.lookup(known, section, _clock() - start)
+        return counterpart
+
+    def _lookup(self, known, relpath=os.path.relpath):
+
+        counterpart = self._map_get(known)
+        if counterpart is _MISSING:
+            counterpart = self._pattern_get(known)
+            if counterpart is _MISSING:
+                counterpart = self._prefix_get(known)
+                if counterpart is _MISSING:
+                    counterpart = self._dir_get(known, relpath)
+        return counterpart
+
+    def _map_get(self, known):
 
         try:
-            counterpart = self._map_config.get("COUNTERPART_MAP", known)
+            counterpart = self._map_config.get(self.map_section, known)
             logger.debug("Result for %s: %s", known, counterpart)
+            return counterpart
         except (config_parser.NoSectionError, config_parser.NoOptionError):
+            return self._bulk.get(known, _MISSING)
+
+    def _load_rules(self, sections):
+        """Build the matchers for the rule sections, which (unlike
+        COUNTERPART_MAP) any lookup may need, so every one of their
+        options must resolve.
+
+        """
+        resolved = {}
+        for section in [self.pattern_section, self.glob_section,
+                        self.prefix_section]:
+            rules, errors = _resolve_section(sections, section,
+                                             own_only=True)
+            for exc in errors.values():
+                raise exc
+            resolved[section] = rules or {}
+        pattern_rules = []
+        for name, value in resolved[self.pattern_section].items():
+            regex, template = _split_rule(self.pattern_section, name, value)
             try:
-                msg = "Nothing for '%s';" % (known)
-                prepend = self._map_config.get("COUNTERPART_DIR",
-                                               "prepend_path")
-                counterpart = os.path.join(prepend, os.path.relpath(known))
-                logger.debug("%s result with prepend (%s): %s",
-                             msg, prepend, counterpart)
-            except config_parser.NoSectionError:
-                logger.debug("%s (and no prepend_path)", msg)
-                raise KeyError("Mapping not found in COUNTERPART_MAP: " +
-                               "%s" % (known))
+                re.compile("(?:%s)\\Z" % (regex))    # as _PatternMatcher does
+            except re.error as exc:
+                raise ValueError("In [%s] %s: bad regular expression "
+                                 "%r: %s" % (self.pattern_section, name,
+                                             regex, exc))
+            pattern_rules.append([regex, template])
+        for name, value in resolved[self.glob_section].items():
+            glob, template = _split_rule(self.glob_section, name, value)
+            pattern_rules.append([_glob_to_regex(glob), template])
+        self._pattern_matcher = _PatternMatcher(pattern_rules)
+        self._prefix_trie = _PrefixTrie(resolved[self.prefix_section])
+
+    def _pattern_get(self, known):
+
+        if self._pattern_matcher is None:
+            self._load_rules(_raw_sections(self._map_config))
+        return self._pattern_matcher.match(known)
+
+    def _prefix_get(self, known):
+
+        if self._prefix_trie is None:
+            self._load_rules(_raw_sections(self._map_config))
+        return self._prefix_trie.match(known)
+
+    def _dir_get(self, known, relpath=os.path.relpath):
 
+        try:
+            prepend = self._map_config.get(self.dir_section, "prepend_path")
+        except (config_parser.NoSectionError, config_parser.NoOptionError):
+            logger.debug("Nothing for '%s'; (and no prepend_path)", known)
+            return _MISSING
+        # An empty string has no relative path; it gets the bare prefix.
+        counterpart = os.path.join(prepend, relpath(known) if known else "")
+        logger.debug("Nothing for '%s'; result with prepend (%s): %s",
+                     known, prepend, counterpart)
         return counterpart
 
 
+class FrozenCounterpartMapping(CounterpartMapping):
+    """A CounterpartMapping whose interpolation is all done when it is
+    created.  COUNTERPART_MAP becomes a flat dict, so that a lookup is
+    one hash probe, and `prepend_path` is expanded just once.
+
+    Option names keep ConfigParser's case-insensitivity.  Unlike
+    ConfigParser, which gives up after a fixed interpolation depth,
+    chains of references may be of any length as long as they do not
+    form a cycle.  An option that cannot be resolved (a cycle, or a
+    reference to a missing option) raises its InterpolationError when
+    it is looked up, not before.
+
+    """
+    def __init__(self, sections, bulk_table=None, profile=None):
+        """:param sections: Raw options, as returned by _raw_sections()
+        :param bulk_table: As for CounterpartMapping.
+        :param profile: As for CounterpartMapping.
+
+        Rules that cannot be resolved in COUNTERPART_PATTERN,
+        COUNTERPART_GLOB or COUNTERPART_PREFIX, which may apply to any
+        lookup, raise their InterpolationError here (and malformed
+        rules, ValueError).
+
+        """
+        self._map_config = None
+        self._sections = sections
+        self._bulk_table = bulk_table
+        self._use_profile(profile)
+        self.source_files = []
+        table, self._errors = _resolve_section(sections, self.map_section)
+        self._table = table or {}
+        dir_options, dir_errors = _resolve_section(sections,
+                                                   self.dir_section)
+        self._prepend = (dir_options or {}).get("prepend_path", _MISSING)
+        self._prepend_error = dir_errors.get("prepend_path")
+        self._load_rules(sections)
+
+    def freeze(self):
+
+        return self
+
+    def profiles(self):
+
+        return _profile_names(self._sections)
+
+    def _new_profile(self, name):
+
+        return FrozenCounterpartMapping(self._sections, self._bulk_table,
+                                        name)
+
+    def _map_items(self):
+        """:return: The COUNTERPART_MAP options and their values."""
+        return self._table.items()
+
+    def _bulk_items(self):
+        """:return: The bulk entries that no option takes precedence over.
+        """
+        return [(known, counterpart)
+                for known, counterpart in self._bulk.items()
+                if known.lower() not in self._table and
+                known.lower() not in self._errors]
+
+    def _items(self):
+        """:return: list of every (string, counterpart) in COUNTERPART_MAP
+            and the bulk entries.
+
+        """
+        return list(self._map_items()) + list(self._bulk_items())
+
+    def _map_get(self, known):
+
+        counterpart = self._table.get(known.lower(), _MISSING)
+        if counterpart is _MISSING:
+            if self._errors:
+                # Options that cannot be interpolated fail only when
+                # asked for, just as they would with ConfigParser.
+                exc = self._errors.get(known.lower())
+                if exc is not None:
+                    raise exc
+            if self._bulk:
+                return self._bulk.get(known, _MISSING)
+        return counterpart
+
+    def _dir_get(self, known, relpath=os.path.relpath):
+
+        if self._prepend is _MISSING:
+            if self._prepend_error is not None:
+                raise self._prepend_error
+            return _MISSING
+        return os.path.join(self._prepend, relpath(known) if known else "")
+
+
+class IndexedCounterpartMapping(FrozenCounterpartMapping):
+    """A CounterpartMapping served straight from an index file written by
+    compile_counterpart_index().  The file is memory-mapped, so opening
+    it costs the same whatever the size of the mapping, and processes
+    using the same index share its pages.
+
+    The index is a hash table of COUNTERPART_MAP entries (open
+    addressing, keyed by CRC-32 of the case-folded string), plus the
+    resolved rules of the other sections as a small JSON header.  An
+    entry for an option matches its string in any case; one from a bulk
+    source, flagged as such, matches only in the case it was written.
+    (Indexes written before bulk sources, CPINDEX1, can still be read.)
+    An index holds just the profile (see CounterpartMapping.profile())
+    that it was compiled from.
+
+    """
+    magic = b"CPINDEX2"
+    _readable_magics = [b"CPINDEX1", magic]
+    _header = struct.Struct("<8sIII")    # magic, meta_len, nslots, nentries
+    _slot = struct.Struct("<I")          # 0 = empty, else entry number + 1
+    _entry = struct.Struct("<QIQI")      # key_off, key_len, val_off, val_len
+    _exact_case = 0x80000000             # key_len flag for a bulk entry
+    _none_len = 0xffffffff               # val_len for an option w/o value
+
+    def __init__(self, index_path):
+
+        logger.debug("NEW: IndexedCounterpartMapping w/%s", index_path)
+        self._map_config = None
+        self._index_path = index_path
+        self.source_files = [index_path]
+        with open(index_path, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_len, nslots, nentries = self._header.unpack_from(self._mm)
+        if magic not in self._readable_magics:
+            raise ValueError("Not a counterparts index: %s" % (index_path))
+        meta_off = self._header.size
+        meta = json.loads(self._mm[meta_off:meta_off + meta_len]
+                          .decode("utf-8"))
+        self._prepend = meta.get("prepend_path", _MISSING)
+        self._prepend_error = None
+        self._errors = {}
+        self._bulk_table = None
+        self.profile_name = meta.get("profile")
+        self._use_profile(self.profile_name)
+        self._prefix_trie = _PrefixTrie(meta.get("prefix_rules", {}))
+        self._pattern_matcher = _PatternMatcher(meta.get("pattern_rules",
+                                                         []))
+        self._mask = nslots - 1
+        self._slots_off = meta_off + _pad8(meta_len)
+        self._entries_off = self._slots_off + nslots * self._slot.size
+        self._blob_off = self._entries_off + nentries * self._entry.size
+
+    @classmethod
+    def is_index(this_class, path):
+        """:return: True if `path` starts like a compiled index file."""
+        try:
+            with open(path, "rb") as fp:
+                return (fp.read(len(this_class.magic)) in
+                        this_class._readable_magics)
+        except (IOError, OSError):
+            return False
+
+    def close(self):
+
+        self._mm.close()
+
+    def profiles(self):
+
+        return [self.profile_name] if self.profile_name else []
+
+    def _new_profile(self, name):
+
+        raise KeyError("%s holds only the %s sections" %
+                       (self._index_path, self.map_section))
+
+    def _entries(self):
+        """Yield (string, counterpart, exact_case) for every entry."""
+        mm = self._mm
+        for number in range((self._blob_off - self._entries_off) //
+                            self._entry.size):
+            key_off, key_len, val_off, val_len = self._entry.unpack_from(
+                mm, self._entries_off + number * self._entry.size)
+            key_off += self._blob_off
+            val_off += self._blob_off
+            exact_case = bool(key_len & self._exact_case)
+            key_len &= ~self._exact_case
+            yield (mm[key_off:key_off + key_len].decode("utf-8"),
+                   None if val_len == self._none_len else
+                   mm[val_off:val_off + val_len].decode("utf-8"),
+                   exact_case)
+
+    def _map_items(self):
+
+        return [(known, counterpart) for known, counterpart, exact_case
+                in self._entries() if not exact_case]
+
+    def _bulk_items(self):
+
+        return [(known, counterpart) for known, counterpart, exact_case
+                in self._entries() if exact_case]
+
+    def _map_get(self, known):
+
+        mm = self._mm
+        key = known.lower().encode("utf-8")
+        exact_key = known.encode("utf-8")
+        i = (zlib.crc32(key) & 0xffffffff) & self._mask
+        while True:
+            slot, = self._slot.unpack_from(mm, self._slots_off +
+                                           i * self._slot.size)
+            if not slot:
+                return _MISSING
+            key_off, key_len, val_off, val_len = self._entry.unpack_from(
+                mm, self._entries_off + (slot - 1) * self._entry.size)
+            key_off += self._blob_off
+            if key_len & self._exact_case:
+                key_len &= ~self._exact_case
+                found = mm[key_off:key_off + key_len] == exact_key
+            else:
+                found = mm[key_off:key_off + key_len] == key
+            if found:
+                if val_len == self._none_len:
+                    return None
+                val_off += self._blob_off
+                return mm[val_off:val_off + val_len].decode("utf-8")
+            i = (i + 1) & self._mask
+
+
+class InverseCounterpartMapping:
+    """Looks up which strings a CounterpartMapping maps to a given
+    counterpart.  COUNTERPART_MAP is inverted into a dict, and
+    COUNTERPART_PREFIX rules into a dict of destination prefixes, when
+    this is made; a `prepend_path` result is inverted by stripping
+    `prepend_path` from it.  Rule-derived candidates are only kept if
+    looking them up in the mapping does give the counterpart (e.g. no
+    COUNTERPART_MAP option takes precedence).
+
+    As option names are case-insensitive, the strings found for
+    COUNTERPART_MAP options are in lower case (those from bulk sources
+    keep their case); like lookups, they include the options of the
+    DEFAULT section.  COUNTERPART_PATTERN and COUNTERPART_GLOB rules
+    cannot be inverted, and are not.
+
+    """
+    def __init__(self, mapping):
+
+        frozen = mapping.freeze()
+        self._mapping = frozen
+        self._originals = {}
+        for known, counterpart in frozen._items():
+            if counterpart is not None:
+                self._originals.setdefault(counterpart, []).append(known)
+        self._prefixes = {}
+        for prefix, destination in frozen._prefix_trie.rules.items():
+            key = tuple(_PrefixTrie._components(destination))
+            self._prefixes.setdefault(key, []).append(prefix)
+        self._prepend = (_MISSING if frozen._prepend in (_MISSING, None)
+                         else os.path.join(frozen._prepend, ""))
+
+    def __getitem__(self, counterpart):
+        """:return: The one string that maps to `counterpart`.
+
+        :raise KeyError: if none does.
+        :raise AmbiguousCounterpart: if more than one does.
+
+        """
+        originals = self.originals(counterpart)
+        if not originals:
+            raise KeyError("No mapping in %s to: %s" %
+                           (self._mapping.map_section, counterpart))
+        if len(originals) > 1:
+            raise AmbiguousCounterpart("Several mappings to %s: %s" %
+                                       (counterpart, ", ".join(originals)))
+        return originals[0]
+
+    def get(self, counterpart, default=None):
+        """Like __getitem__, but returns `default` if no string maps to
+        `counterpart`.
+
+        """
+        try:
+            return self[counterpart]
+        except AmbiguousCounterpart:
+            raise
+        except KeyError:
+            return default
+
+    def originals(self, counterpart):
+        """:return: list of every string found to map to `counterpart`:
+            COUNTERPART_MAP options first, as they appear in the config,
+            then those from COUNTERPART_PREFIX and `prepend_path`.
+
+        """
+        originals = list(self._originals.get(counterpart, []))
+        candidates = []
+        if self._prefixes:
+            components = _PrefixTrie._components(counterpart)
+            for depth in range(len(components), 0, -1):
+                for prefix in self._prefixes.get(tuple(components[:depth]),
+                                                 []):
+                    candidates.append(os.path.join(prefix,
+                                                   *components[depth:]))
+        if (self._prepend is not _MISSING and
+                counterpart.startswith(self._prepend)):
+            candidates.append(counterpart[len(self._prepend):])
+        for candidate in candidates:
+            if (candidate not in originals and
+                    self._mapping.get(candidate, _MISSING) == counterpart):
+                originals.append(candidate)
+        return originals
+
+    def collisions(self):
+        """:return: dict of the counterparts that more than one
+            COUNTERPART_MAP option maps to, and those options.
+
+        """
+        return dict((counterpart, knowns)
+                    for counterpart, knowns in self._originals.items()
+                    if len(knowns) > 1)
+
+
+def _pad8(n):
+
+    return (n + 7) & ~7
+
+
+def compile_counterpart_index(mapping, index_path):
+    """Write the fully resolved contents of `mapping` to `index_path`, in
+    the format read by IndexedCounterpartMapping.  The file is written
+    under a temporary name and then renamed into place, so readers
+    never see a partial index.
+
+    :param mapping: CounterpartMapping to compile (frozen if it isn't).
+    :param index_path: Path of the index file to (re)write.
+    :return: The number of COUNTERPART_MAP (and bulk) entries written.
+
+    """
+    mapping = mapping.freeze()
+    for exc in list(mapping._errors.values()) + [mapping._prepend_error]:
+        if exc is not None:
+            raise exc
+    cls = IndexedCounterpartMapping
+    meta = {"prefix_rules": mapping._prefix_trie.rules,
+            "pattern_rules": mapping._pattern_matcher.rules}
+    if mapping._prepend is not _MISSING:
+        meta["prepend_path"] = mapping._prepend
+    if mapping.profile_name:
+        meta["profile"] = mapping.profile_name
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    items = sorted([(key, value, False)
+                    for key, value in mapping._map_items()] +
+                   [(key, value, True)
+                    for key, value in mapping._bulk_items()])
+    nslots = 8
+    while nslots < 2 * len(items):
+        nslots *= 2
+    slots = [0] * nslots
+    entries = []
+    blob = []
+    blob_len = 0
+    for number, (key, value, exact_case) in enumerate(items):
+        key_bytes = key.encode("utf-8")
+        value_bytes = b"" if value is None else value.encode("utf-8")
+        entries.append(cls._entry.pack(
+            blob_len,
+            len(key_bytes) | (cls._exact_case if exact_case else 0),
+            blob_len + len(key_bytes),
+            cls._none_len if value is None else len(value_bytes)))
+        blob.extend([key_bytes, value_bytes])
+        blob_len += len(key_bytes) + len(value_bytes)
+        i = (zlib.crc32(key.lower().encode("utf-8")) &
+             0xffffffff) & (nslots - 1)
+        while slots[i]:
+            i = (i + 1) & (nslots - 1)
+        slots[i] = number + 1
+    tmp_path = "%s.tmp%d" % (index_path, os.getpid())
+    with open(tmp_path, "wb") as fp:
+        fp.write(cls._header.pack(cls.magic, len(meta_bytes),
+                                  nslots, len(entries)))
+        fp.write(meta_bytes.ljust(_pad8(len(meta_bytes)), b"\0"))
+        fp.write(struct.pack("<%dI" % (nslots), *slots))
+        fp.write(b"".join(entries))
+        fp.write(b"".join(blob))
+    os.rename(tmp_path, index_path)
+    logger.debug("compiled %d entries into %s", len(entries), index_path)
+    return len(entries)
+
+
+def dump_counterpart_mapping(mapping, fp, format="tsv"):
+    """Write the fully resolved COUNTERPART_MAP entries of `mapping`
+    (including bulk entries and DEFAULT options), sorted, to the text
+    file `fp`, in a form that can be loaded again as a bulk source (see
+    ConfigFromFile).  The rules of the other sections are not written.
+
+    :param mapping: CounterpartMapping to dump (frozen if it isn't).
+    :param fp: Text file to write to.
+    :param format: "tsv" or "json".
+    :return: The number of entries written.
+
+    """
+    mapping = mapping.freeze()
+    for exc in mapping._errors.values():
+        raise exc
+    items = sorted(mapping._items())
+    if format == "json":
+        fp.write("{")
+        for number, (known, counterpart) in enumerate(items):
+            fp.write("%s\n%s: %s" % ("," if number else "",
+                                     json.dumps(known),
+                                     json.dumps(counterpart)))
+        fp.write("\n}\n")
+    elif format == "tsv":
+        for known, counterpart in items:
+            if counterpart is None:
+                fp.write("%s\n" % (_escape_tsv(known)))
+            else:
+                fp.write("%s\t%s\n" % (_escape_tsv(known),
+                                        _escape_tsv(counterpart)))
+    else:
+        raise ValueError("Unknown dump format: %s" % (format))
+    return len(items)
+
+
+def _shell_quote(string):
+
+    return "'%s'" % (string.replace("'", "'\\''"))
+
+
+_SHELL_LOOKUP_FUNCTION = r"""
+counterpart_lookup() {
+    local known="$1" key bounded dest rest
+    key=%(lowercase)s
+    if [[ -n $known && ${COUNTERPART_MAP[$key]+set} ]]; then
+        printf '%%s\n' "${COUNTERPART_MAP[$key]}"
+        return 0
+    fi
+    if [[ -n $known && ${COUNTERPART_BULK[$known]+set} ]]; then
+        printf '%%s\n' "${COUNTERPART_BULK[$known]}"
+        return 0
+    fi
+    case $known in
+        /*) bounded="$known/" ;;
+        *) bounded="/$known/" ;;
+    esac
+    case $bounded in
+        */./*|*/../*|//*|*//*) %(not_normal)s ;;
+    esac
+    %(pattern_rules)s
+    while [[ ${#COUNTERPART_PREFIXES[@]} -gt 0 ]]; do
+        if [[ ${COUNTERPART_PREFIXES[${key:-/}]+set} ]]; then
+            dest=${COUNTERPART_PREFIXES[${key:-/}]}
+            rest=${known:${#key}}
+            if [[ -n $rest && ( -z $dest || $dest == */ ) ]]; then
+                rest=${rest#/}
+            fi
+            printf '%%s\n' "$dest$rest"
+            return 0
+        fi
+        [[ $key == */* ]] || break
+        key=${key%%/*}
+    done
+    if [[ -n ${COUNTERPART_PREPEND_PATH+set} ]]; then
+        [[ $known == /* ]] && { %(command)s; return; }
+        printf '%%s\n' "$COUNTERPART_PREPEND_PATH$known"
+        return 0
+    fi
+    %(else_action)s
+}
+"""
+
+
+def export_counterpart_shell(mapping, fp, shell="bash",
+                             else_action="exception", else_errno=1,
+                             config_file=None):
+    """Write `mapping` as bash or zsh code to be sourced, so that shell
+    scripts can look up many strings without running counterpart for
+    each.  The code sets COUNTERPART_MAP, an associative array of the
+    fully resolved COUNTERPART_MAP options (keyed by lowercased string;
+    options without a value map to ""), and COUNTERPART_BULK, one of
+    the bulk entries (keyed by string as written).  It defines
+    counterpart_lookup STRING, which prints the counterpart of STRING
+    or does what `else_action` says, returning the status that the
+    counterpart command would.
+
+    COUNTERPART_PREFIX rules and `prepend_path` are applied in the
+    shell too, for relative paths in normal form (and, for prefix
+    rules, absolute ones).  What the shell cannot work out alike (any
+    string missing from COUNTERPART_MAP, if there are pattern rules;
+    ".." and such; absolute paths under `prepend_path`, which depend
+    on the physical working directory) is passed to the counterpart
+    command, run with `config_file` (and the mapping's profile).
+
+    :param shell: "bash" (version 4.2 or later) or "zsh".
+    :return: The number of COUNTERPART_MAP (and bulk) entries written.
+
+    """
+    mapping = mapping.freeze()
+    for exc in list(mapping._errors.values()) + [mapping._prepend_error]:
+        if exc is not None:
+            raise exc
+    if shell == "bash":
+        lowercase = '${known,,}'
+        entry_format = "    [%s]=%s"
+    elif shell == "zsh":
+        lowercase = '${(L)known}'
+        entry_format = "    %s %s"
+    else:
+        raise ValueError("Unknown shell: %s" % (shell))
+    command = ("command counterpart -c %s%s -a %s -e %d -- \"$known\"" %
+               (_shell_quote(os.path.abspath(
+                   config_file or ConfigFromFile.rc_file_basename)),
+                (" -p %s" % (_shell_quote(mapping.profile_name))
+                 if mapping.profile_name else ""),
+                else_action, else_errno))
+    message = "No counterpart found for: "
+    else_actions = {
+        "passthrough": ("printf '%%s\\n' \"$known\"; return %d" %
+                        (else_errno)),
+        "silent": "return 1",
+        "error": ("printf '# %s%%s\\n' \"$known\" >&2; return %d" %
+                  (message, else_errno)),
+        "exception": ("printf \"KeyError: '%s%%s'\\n\" \"$known\" >&2; "
+                      "return 1" % (message))}
+    items = sorted(mapping._map_items())
+    bulk_items = sorted(mapping._bulk_items())
+    fp.write("# Generated by counterpart --export-shell %s; source it.\n" %
+             (shell))
+    fp.write("typeset -gA COUNTERPART_MAP COUNTERPART_BULK "
+             "COUNTERPART_PREFIXES\n")
+    for name, entries in [
+            ("COUNTERPART_MAP", items),
+            ("COUNTERPART_BULK", bulk_items),
+            ("COUNTERPART_PREFIXES",
+             sorted(("/".join(_PrefixTrie._components(prefix)).lower() or
+                     "/", destination)
+                    for prefix, destination in
+                    mapping._prefix_trie.rules.items()))]:
+        fp.write("%s=(\n" % (name))
+        for known, counterpart in entries:
+            fp.write(entry_format % (_shell_quote(known),
+                                     _shell_quote(counterpart or "")) +
+                     "\n")
+        fp.write(")\n")
+    if mapping._prepend is None:
+        fp.write("unset COUNTERPART_PREPEND_PATH\n")
+        pattern_rules = "%s; return" % (command)
+    else:
+        if mapping._prepend is _MISSING:
+            fp.write("unset COUNTERPART_PREPEND_PATH\n")
+        else:
+            fp.write("COUNTERPART_PREPEND_PATH=%s\n" %
+                     (_shell_quote(os.path.join(mapping._prepend, ""))))
+        pattern_rules = ("%s; return" % (command)
+                         if mapping._pattern_matcher.rules else ":")
+    # With no rules and no prepend_path, a string that is not a path in
+    # normal form has no counterpart anyway:
+    not_normal = ("%s; return" % (command)
+                  if (pattern_rules != ":" or mapping._prefix_trie.rules or
+                      mapping._prepend is not _MISSING)
+                  else else_actions[else_action])
+    fp.write(_SHELL_LOOKUP_FUNCTION % {
+        "lowercase": lowercase, "command": command,
+        "not_normal": not_normal, "pattern_rules": pattern_rules,
+        "else_action": else_actions[else_action]})
+    return len(items) + len(bulk_items)
+
+
 class ConfigFromFile:
 
     rc_file_basename = config_file_basename
     shared_environ = {'home': os.environ["HOME"]}
 
     def __init__(self, config_file=None,
-                 add_rc_files=[], skip_file_read=[]):
+                 add_rc_files=[], skip_file_read=[], tracer=None,
+                 file_contents=None):
         """Only the "implicit" paths are optional; if they or any other files
         are passed as config_file or in add_rc_files (and not supposed
         to be skipped), they are required.
 
+        :param tracer: If given, its file_read() is told how long each
+            file took to read (see CounterpartStats).
+        :param file_contents: dict of the text of files already read,
+            by path (None for a file that does not exist); these are
+            parsed from memory instead of being read again.
+
+        A file named *.tsv or *.json, whether INCLUDEd or passed in,
+        is a bulk source rather than a config file:  its entries go
+        straight into bulk_table, without ConfigParser (see
+        _read_bulk()).
+
         """
-        logger.debug("config_file = %s, " % (config_file) +
-                     "add_rc_files = %s, " % (add_rc_files) +
-                     "skip_file_read = %s " % (skip_file_read))
+        logger.debug("config_file = %s, add_rc_files = %s, "
+                     "skip_file_read = %s",
+                     config_file, add_rc_files, skip_file_read)
         self._local_rc_file = config_file or self.rc_file_basename
         self._parsed_files = []
+        self._tracer = tracer
+        self._include_depth = 0
+        self._file_contents = file_contents or {}
+        self._visited = set()       # normalized paths of files read
+        self._reading = []          # the chain of INCLUDEs being read
+        self._prefetch_pool = None
+        self.include_tree = []      # (depth, path, what became of it)
+        self.bulk_table = {}        # entries read from bulk sources
         parser = ConfigParser(defaults=self.shared_environ,
                               allow_no_value=True)
         self._parser = parser
@@ -113,16 +1498,40 @@ class ConfigFromFile:
                                        self._local_rc_file] +
                                       add_rc_files)
                           if f not in skip_file_read]
-        for f in files_to_parse:
-            optional_flag = (f is not config_file and
-                             f not in add_rc_files)
-            self._handle_rc_file(f, optional_flag)
+        try:
+            for f in files_to_parse:
+                optional_flag = (f is not config_file and
+                                 f not in add_rc_files)
+                self._handle_rc_file(f, optional_flag)
+        finally:
+            if self._prefetch_pool is not None:
+                self._prefetch_pool.shutdown()
 
     @property
     def home_rc_file_path(self):
 
         return os.path.join(os.getenv('HOME'), self.rc_file_basename)
 
+    def explain_includes(self):
+        """:return: Text showing each file read, in the order read (later
+            files take precedence), indented under the file that
+            INCLUDEd it.
+
+        """
+        lines = []
+        for depth, path, status in self.include_tree:
+            lines.append("%s%s%s" % ("  " * depth, path,
+                                     "" if status == "read" else
+                                     "  (%s)" % (status)))
+        return "\n".join(lines) + "\n"
+
+    def file_signature(self):
+        """:return: The path, size and mtime of every file that was read,
+            or tried and found missing, in loading this configuration.
+
+        """
+        return _file_signature(self._parsed_files)
+
     @classmethod
     def register_options(this_class, argparser):
         """This class method is called so that ConfigFromFile can tell the
@@ -145,6 +1554,10 @@ class ConfigFromFile:
         the parser set `paths`, it is cleared so that they do not keep
         showing up when additional files are parsed.
 
+        Each file is read only once: a file that is INCLUDEd again (as
+        when two files include a third) is skipped the second time.
+        Only a file that includes itself, directly or not, is an error.
+
         """
         logger.debug("Check/handle includes from %s", from_file)
         try:
@@ -156,47 +1569,331 @@ class ConfigFromFile:
         paths_lines = [p.strip() for p in paths.split("\n")]
         logger.debug("paths = %s (wanted just once; CLEARING)", paths_lines)
         self._parser.remove_option("INCLUDE", "paths")
-        for f in paths_lines:
-            abspath = (f if os.path.isabs(f) else
-                       os.path.abspath(
-                           os.path.join(os.path.dirname(from_file), f)))
-            use_path = os.path.normpath(abspath)
-            if use_path in self._parsed_files:
-                raise RecursionInConfigFile("In %s: %s already read",
-                                            from_file, use_path)
-            self._parsed_files.append(use_path)
-            self._handle_rc_file(use_path)
+        use_paths = [self.include_path(from_file, f) for f in paths_lines]
+        self._prefetch([p for p in use_paths if p not in self._visited])
+        for use_path in use_paths:
+            if use_path in self._reading:
+                raise RecursionInConfigFile(
+                    "In %s: %s is included by itself (%s)" %
+                    (from_file, use_path,
+                     " -> ".join(self._reading[self._reading.index(
+                         use_path):] + [use_path])))
+            if use_path in self._visited:
+                logger.debug("%s already read; skipped", use_path)
+                self.include_tree.append((self._include_depth + 1,
+                                          use_path, "already read"))
+                continue
+            self._include_depth += 1
+            try:
+                self._handle_rc_file(use_path)
+            finally:
+                self._include_depth -= 1
+
+    def _prefetch(self, paths):
+        """Read INCLUDEd files that are not read yet all at once, with a
+        pool of threads, to be parsed (in order) from memory.
+
+        """
+        paths = [p for p in paths
+                 if p not in self._file_contents and not _is_bulk_source(p)]
+        if len(paths) < 2:
+            return
+        if self._prefetch_pool is None:
+            try:
+                from concurrent.futures import ThreadPoolExecutor
+            except ImportError:
+                return
+            self._prefetch_pool = ThreadPoolExecutor(8)
+        self._file_contents.update(zip(paths, self._prefetch_pool.map(
+            _read_text, paths)))
+
+    @staticmethod
+    def include_path(from_file, f):
+        """:return: Where the INCLUDE path `f` in `from_file` points."""
+        abspath = (f if os.path.isabs(f) else
+                   os.path.abspath(
+                       os.path.join(os.path.dirname(from_file), f)))
+        return os.path.normpath(abspath)
+
+    def _read(self, from_file):
+
+        if _is_bulk_source(from_file):
+            return self._read_bulk(from_file)
+        if from_file not in self._file_contents:
+            return self._parser.read(from_file)
+        text = self._file_contents[from_file]
+        if text is None:
+            return []
+        if hasattr(self._parser, "read_string"):
+            self._parser.read_string(text, from_file)
+        else:
+            import StringIO
+            self._parser.readfp(StringIO.StringIO(text), from_file)
+        return [from_file]
+
+    def _read_bulk(self, from_file):
+        """Load a bulk source into bulk_table (a TSV file a line at a
+        time, so that it is never all in memory).  A TSV file holds
+        "string<TAB>counterpart" lines, with tabs, newlines and
+        backslashes in either escaped as \\t, \\n and \\\\ (a line
+        without a tab maps its string to None); a JSON file holds one
+        object of strings to strings (or null).  Unlike option names,
+        the strings are kept just as written, so case matters in them;
+        those read later take precedence.
+
+        :return: [from_file], or [] if it does not exist (like
+            ConfigParser.read()).
+
+        """
+        try:
+            fp = io.open(from_file, encoding="utf-8")
+        except (IOError, OSError):
+            return []
+        with fp:
+            if from_file.lower().endswith(".json"):
+                entries = _read_json_bulk(fp, from_file)
+            else:
+                entries = _read_tsv_bulk(fp)
+            self.bulk_table.update(entries)
+        logger.debug("%d bulk entries so far, after %s",
+                     len(self.bulk_table), from_file)
+        return [from_file]
+
+    def _handle_rc_file(self, from_file, optional_flag=True):
+
+        logger.debug("path=%s, optional=%s", from_file, optional_flag)
+        self._parsed_files.append(from_file)
+        use_path = os.path.normpath(os.path.abspath(from_file))
+        self._visited.add(use_path)
+        if self._tracer is None:
+            success = self._read(from_file)
+        else:
+            start = _clock()
+            success = self._read(from_file)
+            self._tracer.file_read(from_file, _clock() - start,
+                                   self._include_depth)
+        if not success and not optional_flag:
+            logger.debug("unsuccessful read of %s from %s",
+                         from_file, os.getcwd())
+            if not os.path.exists(from_file):
+                raise FileNotFound(from_file)
+            else:
+                raise IOError("ConfigParser for %s", from_file)
+        logger.debug("successful read of %s = %s", from_file, success)
+        self.include_tree.append((self._include_depth, from_file,
+                                  "read" if success else "missing"))
+        if _is_bulk_source(from_file):
+            return          # no INCLUDE section in a bulk source
+        self._reading.append(use_path)
+        try:
+            self._check_and_handle_includes(from_file)
+        finally:
+            self._reading.pop()
+
+
+def _is_bulk_source(path):
+    """:return: Whether `path` names a TSV or JSON bulk source."""
+    return path.lower().endswith((".tsv", ".json"))
+
+
+_tsv_escapes = [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"),
+                ("\r", "\\r")]
+_tsv_unescapes = {"\\": "\\", "t": "\t", "n": "\n", "r": "\r"}
+
+
+def _unescape_tsv(field):
+
+    if "\\" not in field:
+        return field
+    return re.sub(r"\\(.)", lambda m: _tsv_unescapes.get(m.group(1),
+                                                        m.group(0)), field)
+
+
+def _escape_tsv(field):
+
+    for char, escaped in _tsv_escapes:
+        field = field.replace(char, escaped)
+    return field
+
+
+def _read_tsv_bulk(fp):
+    """:return: Generator of (string, counterpart) from the TSV lines in
+        the file `fp` (see ConfigFromFile._read_bulk()).
+
+    """
+    for line in fp:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        known, tab, counterpart = line.partition("\t")
+        yield (_unescape_tsv(known),
+               _unescape_tsv(counterpart) if tab else None)
+
+
+def _read_json_bulk(fp, from_file):
+    """:return: The (string, counterpart) pairs of the JSON object in the
+        file `fp`, checked to hold only strings (or null counterparts).
+
+    """
+    try:
+        table = json.load(fp)
+    except ValueError as exc:
+        raise ValueError("In %s: %s" % (from_file, exc))
+    if not isinstance(table, dict):
+        raise ValueError("In %s: expected an object of strings" %
+                         (from_file))
+    for known, counterpart in table.items():
+        if counterpart is not None and not isinstance(counterpart,
+                                                      type(known)):
+            raise ValueError("In %s: counterpart of %s is not a string" %
+                             (from_file, known))
+    return list(table.items())
+
+
+def _read_text(path):
+    """:return: The text of the file at `path`, or None if it cannot be
+        opened (which ConfigParser.read() also takes as missing).
+
+    """
+    try:
+        with open(path) as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return None
+
+
+def _file_signature(paths):
+    """Stat each of the given paths, once each, in order.  Missing files
+    are included too, so that creating one is noticed as a change.
+
+    :return: list of [abspath, size, mtime] (size and mtime None if
+        the file does not exist).
+
+    """
+    signature = []
+    seen = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            st = os.stat(path)
+            signature.append([path, st.st_size,
+                              getattr(st, "st_mtime_ns", st.st_mtime)])
+        except OSError:
+            signature.append([path, None, None])
+    return signature
+
+
+class _ParseCache:
+    """On-disk cache of loaded config files, keyed by which files were
+    asked for and validated against the paths, sizes and mtimes of all
+    the files that the load actually read (INCLUDEs too).  An entry
+    is reused only while that whole file set is unchanged.
+
+    Entries live in $XDG_CACHE_HOME/counterparts (~/.cache/counterparts
+    by default), one JSON file per distinct set of arguments.  Files
+    are named by a cheap checksum of those arguments (hashlib takes
+    longer to import than a cached load takes), and each entry holds
+    the arguments in full, so that a clash is only a miss.
+
+    """
+    def __init__(self, cache_dir=None):
+
+        if cache_dir is None:
+            cache_home = (os.getenv("XDG_CACHE_HOME") or
+                          os.path.join(os.getenv("HOME"), ".cache"))
+            cache_dir = os.path.join(cache_home, "counterparts")
+        self.cache_dir = cache_dir
+
+    def _entry_key(self, kind, file_list):
+        """:return: (The arguments as a string, where their entry lives)
+        """
+        key = json.dumps([__version__, kind, os.getcwd(), file_list])
+        key_bytes = key.encode("utf-8")
+        digest = "%08x%08x" % (zlib.crc32(key_bytes) & 0xffffffff,
+                               zlib.adler32(key_bytes) & 0xffffffff)
+        return key, os.path.join(self.cache_dir,
+                                 "%s-%s.json" % (kind, digest))
+
+    def get(self, kind, file_list):
+        """:return: (The cached data, or None if missing or out of date;
+            the files it was made from)
+
+        """
+        key, entry_path = self._entry_key(kind, file_list)
+        try:
+            with open(entry_path) as fp:
+                entry = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None, []
+        if entry.get("key") != key:
+            return None, []
+        paths = [path for path, __, __ in entry.get("signature", [])]
+        if entry.get("signature") != _file_signature(paths):
+            logger.debug("stale cache entry %s", entry_path)
+            return None, []
+        logger.debug("using cache entry %s", entry_path)
+        return entry["data"], paths
+
+    def put(self, kind, file_list, signature, data):
+        """Store `data`, valid while `signature` still matches.  Failing to
+        write the cache is not an error; the next load just parses again.
 
-    def _handle_rc_file(self, from_file, optional_flag=True):
+        """
+        key, entry_path = self._entry_key(kind, file_list)
+        tmp_path = "%s.tmp%d" % (entry_path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+            with open(tmp_path, "w") as fp:
+                json.dump({"key": key, "signature": signature,
+                           "data": data}, fp)
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError) as exc:
+            logger.debug("cannot write cache entry %s: %s", entry_path, exc)
 
-        logger.debug("path=%s, optional=%s", from_file, optional_flag)
-        self._parsed_files.append(from_file)
-        success = self._parser.read(from_file)
-        if not success and not optional_flag:
-            logger.debug("unsuccessful read of %s from %s",
-                         from_file, os.getcwd())
-            if not os.path.exists(from_file):
-                raise FileNotFound(from_file)
-            else:
-                raise IOError("ConfigParser for %s", from_file)
-        logger.debug("successful read of %s = %s", from_file, success)
-        self._check_and_handle_includes(from_file)
+
+def _record_end(options):
+    """:return: What follows each record written for the given options."""
+    if getattr(options, "null", False):
+        return "\0"
+    return "" if options.no_newline else "\n"
 
 
-def counterpart_found(string, counterpart, options, rc_so_far):
+def counterpart_found(string, counterpart, options, rc_so_far, output=None):
     """The sunny-day action is to echo the counterpart to stdout.
 
-    :param string: The lookup string  (UNUSED)
+    :param string: The lookup string  (used only with options.tsv)
     :param counterpart: The counterpart that the string mapped to
-    :param options: ArgumentParser or equivalent to provide options.no_newline
+    :param options: ArgumentParser or equivalent to provide
+        options.no_newline (and optionally options.null, options.tsv)
     :param rc_so_far: Stays whatever value it was.
+    :param output: Where to write, if not sys.stdout.
     """
-    format = "%s" if options.no_newline else "%s\n"
-    sys.stdout.write(format % (counterpart))
+    if getattr(options, "tsv", False):
+        counterpart = "%s\t%s" % (string, counterpart)
+    (output or sys.stdout).write("%s%s" % (counterpart, _record_end(options)))
     return rc_so_far or 0
 
 
-def no_counterpart_found(string, options, rc_so_far):
+def comparison_found(string, counterpart, result, options, rc_so_far,
+                     output=None):
+    """Output how a file compared with its counterpart (see
+    compare_files), as "RESULT<TAB>STRING<TAB>COUNTERPART".
+
+    :return: rc_so_far, or 1 unless the files are identical (or both
+        directories).
+
+    """
+    (output or sys.stdout).write("%s\t%s\t%s" % (result, string,
+                                                 counterpart) +
+                                 _record_end(options))
+    return rc_so_far or (0 if result in ["identical", "directory"] else 1)
+
+
+def no_counterpart_found(string, options, rc_so_far, output=None):
     """Takes action determined by options.else_action.  Unless told to
     raise an exception, this function returns the errno that is supposed
     to be returned in this case.
@@ -204,25 +1901,62 @@ def no_counterpart_found(string, options, rc_so_far):
     :param string: The lookup string.
     :param options: ArgumentParser or equivalent to provide
         options.else_action, options.else_errno, options.no_newline
+        (and optionally options.null, options.tsv)
     :param rc_so_far: Becomes set to the value set in options.
+    :param output: Where to write a passthrough, if not sys.stdout.
 
     """
     logger.debug("options.else_action: %s", options.else_action)
     if options.else_action == "passthrough":
-        format_list = [string]
-        output_fd = sys.stdout
+        counterpart_found(string, string, options, rc_so_far, output)
     elif options.else_action == "exception":
         raise KeyError("No counterpart found for: %s" % (string))
     elif options.else_action == "error":
-        format_list = ["# No counterpart found for: %s" % (string)]
-        output_fd = sys.stderr
-    if not options.no_newline:
-        format_list.append("\n")
-    output_fd.write("".join(format_list))
+        sys.stderr.write("# No counterpart found for: %s" % (string) +
+                         _record_end(options))
     return options.else_errno
 
 
-def get_counterpart_mapping(config_file=None, skip_home=False):
+class _BufferedOutput:
+    """Gathers many small writes into a few large ones.  The text is
+    encoded as file names are, so names read from the input (see
+    _read_records()) are written out byte for byte.
+
+    """
+
+    def __init__(self, fp, limit=1 << 16):
+
+        self._fp = fp
+        self._limit = limit
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self._limit:
+            self.flush()
+
+    def flush(self):
+
+        if self._parts:
+            text = "".join(self._parts)
+            self._parts = []
+            self._size = 0
+            binary = getattr(self._fp, "buffer", None)
+            if binary is None:
+                self._fp.write(text)
+            else:
+                self._fp.flush()
+                binary.write(_fsencode(text))
+                binary.flush()
+        self._fp.flush()
+
+
+def get_counterpart_mapping(config_file=None, skip_home=False, frozen=False,
+                            cache=False, tracer=None, shared=True,
+                            profile=None):
     """Initial part of a two-step lookup: First load the mapping
     (CounterpartMapping) with this function.  The mapping can then be
     subscripted to look up specific counterparts' mappings.  This way
@@ -232,16 +1966,176 @@ def get_counterpart_mapping(config_file=None, skip_home=False):
     :param config_file: Path to a config file to guide the mapping.
            Default is to use ./counterc and/or ~/.countrc.
     :param skip_home: If True, only the config_file is read.
-    :return: CounterpartMapping loaded from config_file et al.
+    :param frozen: If True, resolve the whole mapping up front (see
+           FrozenCounterpartMapping); worthwhile for many lookups.
+    :param cache: If True (or the path of a cache directory), reuse what
+           an earlier load parsed, unless any of the files it read have
+           changed since.  The mapping returned is then always frozen.
+    :param tracer: A CounterpartStats (or similar) to be told how long
+           loading took, and about each lookup made with the mapping.
+    :param shared: If True (and there is no tracer), share what an
+           earlier call with the same arguments loaded, as long as none
+           of its files has changed since (see MappingRegistry).  If
+           False, always load anew.
+    :param profile: Name of the profile to use, rather than the unnamed
+           sections (see CounterpartMapping.profile()).  Only its
+           sections are resolved, even if frozen.
+    :return: CounterpartMapping loaded from config_file et al.  Its
+           `source_files` attribute lists the files it came from.
+
+    If config_file is an index written by compile_counterpart_index(),
+    it is opened as an IndexedCounterpartMapping; no other config files
+    are read, since the index already holds everything they provided.
 
     """
-    file_skip_list = ([ConfigFromFile.home_rc_file_path]
-                      if skip_home else [])
-    config = ConfigFromFile(config_file, [], skip_file_read=file_skip_list)
-    return CounterpartMapping(map_config=config._parser)
+    timer = _PhaseTimer(tracer)
+    if config_file and IndexedCounterpartMapping.is_index(config_file):
+        mapping = IndexedCounterpartMapping(config_file)
+        if profile:
+            mapping = mapping.profile(profile)
+        timer.done("index")
+    elif shared and tracer is None:
+        key = (os.getcwd(), os.getenv('HOME'), config_file, skip_home,
+               frozen, cache, profile)
+        mapping = mapping_registry.get(
+            key, lambda: _load_counterpart_mapping(config_file, skip_home,
+                                                   frozen, cache, None,
+                                                   timer, profile))
+    else:
+        mapping = _load_counterpart_mapping(config_file, skip_home, frozen,
+                                            cache, tracer, timer, profile)
+    if tracer is not None:
+        mapping.set_tracer(tracer)
+    return mapping
 
 
-def map_counterpart(string, config_file=None):
+class _PhaseTimer:
+    """Tells a tracer how long each phase of loading took."""
+
+    def __init__(self, tracer):
+
+        self._tracer = tracer
+        self._start = _clock()
+
+    def done(self, phase):
+
+        if self._tracer is not None:
+            now = _clock()
+            self._tracer.phase(phase, now - self._start)
+            self._start = now
+
+
+def _load_counterpart_mapping(config_file, skip_home, frozen, cache, tracer,
+                              timer, profile=None):
+
+    home_rc_file = os.path.join(os.getenv('HOME'),
+                                ConfigFromFile.rc_file_basename)
+    file_skip_list = [home_rc_file] if skip_home else []
+    if cache:
+        parse_cache = _ParseCache(None if cache is True else cache)
+        file_list = [config_file or ConfigFromFile.rc_file_basename,
+                     home_rc_file, file_skip_list]
+        data, source_files = parse_cache.get("config", file_list)
+        timer.done("cache")
+        if data is None:
+            config = ConfigFromFile(config_file, [],
+                                    skip_file_read=file_skip_list,
+                                    tracer=tracer)
+            data = {"sections": _raw_sections(config._parser),
+                    "bulk": config.bulk_table}
+            signature = config.file_signature()
+            timer.done("parse")
+            parse_cache.put("config", file_list, signature, data)
+            source_files = [path for path, __, __ in signature]
+            timer.done("cache")
+        mapping = FrozenCounterpartMapping(data["sections"], data["bulk"],
+                                           profile)
+        mapping.source_files = source_files
+        timer.done("resolve")
+        return mapping
+    config = ConfigFromFile(config_file, [], skip_file_read=file_skip_list,
+                            tracer=tracer)
+    mapping = CounterpartMapping(map_config=config._parser,
+                                 bulk_table=config.bulk_table,
+                                 profile=profile)
+    mapping.source_files = [path for path, __, __ in config.file_signature()]
+    timer.done("parse")
+    if frozen:
+        mapping = mapping.freeze()
+        timer.done("resolve")
+    return mapping
+
+
+class MappingRegistry:
+    """Loaded mappings, kept so that repeated get_counterpart_mapping()
+    and map_counterpart() calls with the same arguments share one
+    mapping rather than reading the config files every time.
+
+    A mapping is handed out again only while none of the files it was
+    loaded from (INCLUDEs too) has changed, was created or was removed,
+    which costs one stat() per file; otherwise it is loaded anew.  At
+    most `size` mappings are kept, the least recently used going first.
+    It may be used from any number of threads.
+
+    Each caller gets a copy of its own (see CounterpartMapping._copy()),
+    so that the tracer, profiles and so on that one caller sets up are
+    not seen by another; only the parsed config and rules are shared.
+
+    """
+    def __init__(self, size=16):
+
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = _LRUCache(size)
+
+    def get(self, key, load):
+        """:return: A copy of the mapping registered under `key`, if its
+            files are unchanged; otherwise, of the mapping returned by
+            calling `load`, which is registered in its place.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            mapping, signature = entry
+            if _file_signature([path for path, __, __ in
+                                signature]) == signature:
+                with self._lock:
+                    self.hits += 1
+                return mapping._copy()
+        mapping = load()
+        signature = _file_signature(mapping.source_files)
+        with self._lock:
+            self.misses += 1
+            self._entries.put(key, (mapping, signature))
+        return mapping._copy()
+
+    def invalidate(self, config_file=None):
+        """Forget the mappings loaded with `config_file`, or from it (as
+        an INCLUDE, say); or every mapping, if it is None.
+
+        """
+        with self._lock:
+            if config_file is None:
+                self._entries.clear()
+                return
+            path = os.path.abspath(config_file)
+            for key, (mapping, signature) in self._entries.items():
+                if (key[2] == config_file or
+                        path in [p for p, __, __ in signature]):
+                    self._entries.pop(key)
+
+    def __len__(self):
+
+        return len(self._entries)
+
+
+mapping_registry = MappingRegistry()
+
+
+def map_counterpart(string, config_file=None, profile=None):
     """One-step look-up; returns a counterpart for the given string, as
     determined from the config file(s) via ConfigFromFile.
     config_file is read after ~/.counterc, if present, making its
@@ -250,17 +2144,672 @@ def map_counterpart(string, config_file=None):
     :param string: The string to find the counterpart of.
     :param config_file: Path to a config file to guide the mapping.
            Default is to use ./counterc and/or ~/.countrc.
+    :param profile: Name of the profile to use, if any (see
+           CounterpartMapping.profile()).
     :return: String value, the counterpart of the input string.
 
+    The mapping is loaded only on the first call, and again whenever
+    its config files change (see MappingRegistry).
+
     """
     skip_home_flag = config_file is not None
-    mapping = get_counterpart_mapping(config_file, skip_home_flag)
+    mapping = get_counterpart_mapping(config_file, skip_home_flag,
+                                      profile=profile)
     return mapping[string]
 
 
+class ReloadingCounterpartMapping:
+    """A CounterpartMapping for long-lived processes, which replaces
+    itself with a freshly loaded one whenever any of the files the
+    mapping came from (INCLUDEs and ~/.counterc too) is changed,
+    created or removed.
+
+    Changes are looked for at most every `check_interval` seconds, when
+    a lookup is made.  With the optional inotify_simple package on
+    Linux, that costs one non-blocking read; otherwise, one stat() per
+    file.  The new mapping is fully loaded before it replaces the old
+    one, so lookups in other threads see one or the other, never a mix.
+    If the new config cannot be loaded, the old mapping stays in use.
+
+    """
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE,
+    # from <sys/inotify.h>; IN_CREATE covers files made by ln or ln -s.
+    _inotify_flags = 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, config_file=None, skip_home=False, frozen=True,
+                 check_interval=1.0, tracer=None, profile=None):
+
+        self._load_args = (config_file, skip_home, frozen)
+        self._profile = profile
+        self._tracer = tracer
+        self.check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        self._inotify = None
+        self._watched = None
+        self._load()
+
+    def _load(self):
+
+        mapping = get_counterpart_mapping(*self._load_args,
+                                          tracer=self._tracer,
+                                          profile=self._profile)
+        self._signature = _file_signature(mapping.source_files)
+        self._watch([path for path, __, __ in self._signature])
+        self._mapping = mapping
+        self._last_check = time.time()
+
+    def _watch(self, paths):
+        """Watch the directories of `paths` with inotify, if it can be
+        used; the watches already set up are kept if the directories
+        are the same as before, as after most reloads they are.
+
+        """
+        directories = set(os.path.dirname(p) for p in paths)
+        if self._inotify is not None and directories == self._watched:
+            return
+        self.close()
+        try:
+            import inotify_simple
+        except ImportError:
+            return
+        inotify = inotify_simple.INotify()
+        try:
+            for directory in directories:
+                inotify.add_watch(directory, self._inotify_flags)
+        except OSError as exc:
+            logger.debug("inotify unusable, polling instead: %s", exc)
+            inotify.close()
+            return
+        self._inotify = inotify
+        self._watched = directories
+
+    def _changed(self):
+
+        if self._inotify is not None:
+            if not self._inotify.read(timeout=0):
+                return False
+        return _file_signature([path for path, __, __ in
+                                self._signature]) != self._signature
+
+    def close(self):
+        """Stop watching for changes with inotify, if that is in use."""
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def reload(self, force=True):
+        """Load the config files again, if they have changed or `force`.
+        Concurrent calls do not wait; all but one return at once.
+
+        """
+        if not self._reload_lock.acquire(False):
+            return
+        try:
+            self._last_check = time.time()
+            if force or self._changed():
+                logger.debug("reloading %s", self._load_args)
+                try:
+                    self._load()
+                except Exception as exc:
+                    logger.warning("reload failed, keeping old mapping: %s",
+                                   exc)
+                    self._signature = _file_signature(
+                        [path for path, __, __ in self._signature])
+        finally:
+            self._reload_lock.release()
+
+    @property
+    def mapping(self):
+        """The current CounterpartMapping, checked for changes first."""
+        if time.time() - self._last_check >= self.check_interval:
+            self.reload(force=False)
+        return self._mapping
+
+    @property
+    def source_files(self):
+
+        return self._mapping.source_files
+
+    def __getitem__(self, known):
+
+        return self.mapping[known]
+
+    def get(self, known, default=None):
+
+        return self.mapping.get(known, default)
+
+    def map_many(self, strings, default=None, cwd=None):
+
+        return self.mapping.map_many(strings, default, cwd)
+
+    def imap_many(self, strings, default=None, chunk_size=4096):
+
+        for chunk in _chunked(strings, chunk_size):
+            for counterpart in self.mapping.map_many(chunk, default):
+                yield counterpart
+
+    def inverse(self):
+
+        return self.mapping.inverse()
+
+    def profile(self, name):
+
+        return self.mapping.profile(name)
+
+
+def default_socket_path():
+    """:return: Where `counterpart --serve` listens unless told otherwise,
+        which is also where the counterpart command looks for it.
+        Without $XDG_RUNTIME_DIR, that is in a directory of the user's
+        own under /tmp (see _private_socket_dir()).
+
+    """
+    if os.getenv("COUNTERPART_SOCKET"):
+        return os.getenv("COUNTERPART_SOCKET")
+    if os.getenv("XDG_RUNTIME_DIR"):
+        return os.path.join(os.getenv("XDG_RUNTIME_DIR"),
+                            "counterpart-%d.sock" % (os.getuid()))
+    return os.path.join(_fallback_socket_dir(), "counterpart.sock")
+
+
+def _fallback_socket_dir():
+
+    return os.path.join("/tmp", "counterpart-%d" % (os.getuid()))
+
+
+def _private_socket_dir(socket_path):
+    """Make sure that the directory `socket_path` is in can be trusted:
+    create the fallback directory under /tmp (mode 0700) if need be,
+    and refuse it if someone else owns it or can write to it.
+
+    :raise IOError: if the directory is not the user's alone.
+
+    """
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if socket_dir != _fallback_socket_dir():
+        return
+    try:
+        os.mkdir(socket_dir, 0o700)
+    except OSError:
+        pass        # there already; checked below
+    st = os.lstat(socket_dir)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise IOError("Not a private directory: %s" % (socket_dir))
+
+
+def _peer_is_self(sock, socket_path):
+    """:return: Whether the server at the other end of `sock` (connected
+        to socket_path) runs as this user.  Anyone may have made a
+        socket at a well-known path; only our own server is trusted.
+
+    """
+    import socket
+    try:
+        if os.stat(socket_path).st_uid != os.getuid():
+            return False
+    except OSError:
+        return False
+    so_peercred = getattr(socket, "SO_PEERCRED", None)
+    if so_peercred is None:
+        return True     # no way to ask; the socket's owner must do
+    creds = sock.getsockopt(socket.SOL_SOCKET, so_peercred,
+                            struct.calcsize("3i"))
+    pid, uid, gid = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+
+def _config_identity(config_file, skip_home, profile=None):
+    """Which top-level config files (and profile) a mapping is loaded
+    from.  A server answers a client only when both name the same files
+    and profile, so that they would load identical mappings.
+
+    """
+    home_rc_file = os.path.join(os.getenv('HOME'),
+                                ConfigFromFile.rc_file_basename)
+    local_rc_file = config_file or ConfigFromFile.rc_file_basename
+    return json.dumps([os.path.abspath(local_rc_file),
+                       None if skip_home else home_rc_file, profile or None])
+
+
+class _ServerMapping:
+    """Client side of `counterpart --serve`:  looks strings up through a
+    server listening on a Unix socket, which has the mapping already
+    loaded, instead of loading it in this process.
+
+    The protocol is NUL-terminated UTF-8 records, surrogate-escaped so
+    that any file name gets through.  A client first sends its working
+    directory and its _config_identity(), and the server answers "+" to
+    go ahead or "-" if it serves some other config.
+    Each string the client sends is then answered with "=" and its
+    counterpart, "!" if it has none, or "?" and a message if the lookup
+    failed.  For the last, the client repeats the lookup in-process so
+    that the failure is raised here.
+
+    """
+    batch_size = 256
+    connect_timeout = 2.0
+
+    def __init__(self, sock, load_mapping):
+
+        self._sock = sock
+        self._load_mapping = load_mapping
+        self._fallback = None
+        self._buffer = b""
+
+    @classmethod
+    def connect(this_class, socket_path, identity, load_mapping):
+        """:return: A _ServerMapping, or None if no suitable server is
+            listening at socket_path.
+
+        """
+        if not os.path.exists(socket_path):
+            return None
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(this_class.connect_timeout)
+            sock.connect(socket_path)
+            if not _peer_is_self(sock, socket_path):
+                logger.warning("ignoring %s: its server is not run by "
+                               "this user", socket_path)
+                sock.close()
+                return None
+            client = this_class(sock, load_mapping)
+            client._send([os.getcwd(), identity])
+            if client._receive(1) == ["+"]:
+                logger.debug("using server at %s", socket_path)
+                sock.settimeout(None)
+                return client
+        except (IOError, OSError) as exc:
+            logger.debug("no server at %s: %s", socket_path, exc)
+        sock.close()
+        return None
+
+    def close(self):
+
+        self._sock.close()
+
+    def _send(self, records):
+
+        self._sock.sendall("".join(record + "\0" for record in records)
+                           .encode("utf-8", "surrogateescape"))
+
+    def _receive(self, count):
+
+        records = []
+        while len(records) < count:
+            if b"\0" not in self._buffer:
+                data = self._sock.recv(1 << 16)
+                if not data:
+                    raise IOError("server closed the connection")
+                self._buffer += data
+                continue
+            record, self._buffer = self._buffer.split(b"\0", 1)
+            records.append(record.decode("utf-8", "surrogateescape"))
+        return records
+
+    def _lookup_here(self, known, default):
+
+        if self._fallback is None:
+            self._fallback = self._load_mapping()
+        return self._fallback.get(known, default)
+
+    def map_many(self, strings, default=None):
+        """Same as CounterpartMapping.map_many, answered by the server."""
+        counterparts = []
+        for batch in _chunked(strings, self.batch_size):
+            sendable = [known for known in batch if "\0" not in known]
+            try:
+                self._send(sendable)
+                replies = iter(self._receive(len(sendable)))
+            except (IOError, OSError) as exc:
+                logger.debug("server lookup failed: %s", exc)
+                replies = iter(["?"] * len(sendable))
+            for known in batch:
+                reply = next(replies) if "\0" not in known else "?"
+                if reply[:1] == "=":
+                    counterparts.append(reply[1:])
+                elif reply == "!":
+                    counterparts.append(default)
+                else:
+                    counterparts.append(self._lookup_here(known, default))
+        return counterparts
+
+
+def _map_reverse(inverse, strings):
+    """Yield (string, original) for each original that `inverse` finds
+    for each of the strings, or (string, _MISSING) if there is none.
+    Strings with several originals are reported on stderr.
+
+    """
+    for counterpart in strings:
+        originals = inverse.originals(counterpart)
+        if len(originals) > 1:
+            sys.stderr.write("# Several mappings to %s: %s\n" %
+                             (counterpart, ", ".join(originals)))
+        for original in originals or [_MISSING]:
+            yield counterpart, original
+
+
+def _map_serially(mapping, strings, chunk_size=4096):
+    """Yield (string, counterpart or _MISSING) for each of the strings.
+    Should a lookup fail, the strings before it in its chunk are still
+    yielded before its exception is raised.
+
+    """
+    for chunk in _chunked(strings, chunk_size):
+        try:
+            counterparts = mapping.map_many(chunk, _MISSING)
+        except Exception:
+            counterparts = (mapping.map_many([known], _MISSING)[0]
+                            for known in chunk)
+        for pair in zip(chunk, counterparts):
+            yield pair
+
+
+_worker_mapping = None
+
+
+def _init_worker(load_mapping_args):
+    """Process pool initializer:  a worker forked from the main process
+    already has its mapping; any other kind loads its own, once.
+
+    """
+    global _worker_mapping
+    if _worker_mapping is None:
+        _worker_mapping = get_counterpart_mapping(*load_mapping_args)
+
+
+def _map_chunk_in_worker(chunk):
+
+    counterparts = _worker_mapping.map_many(chunk, _MISSING)
+    misses = [i for i, counterpart in enumerate(counterparts)
+              if counterpart is _MISSING]
+    for i in misses:
+        counterparts[i] = None
+    return counterparts, misses
+
+
+def _map_in_parallel(mapping, strings, jobs, load_mapping_args,
+                     chunk_size=4096):
+    """Like _map_serially, but with chunks of strings mapped by a pool of
+    `jobs` processes.  Results are still yielded in input order, and at
+    most 2 * `jobs` chunks are in flight at any time.
+
+    :param load_mapping_args: Arguments to get_counterpart_mapping for
+        workers that do not inherit `mapping` by forking.
+
+    """
+    import collections
+    import multiprocessing
+    global _worker_mapping
+    _worker_mapping = mapping
+    pool = multiprocessing.Pool(jobs, _init_worker, (load_mapping_args,))
+    try:
+        pending = collections.deque()
+        chunks = _chunked(strings, chunk_size)
+        while True:
+            for chunk in chunks:
+                pending.append((chunk, pool.apply_async(_map_chunk_in_worker,
+                                                        (chunk,))))
+                if len(pending) >= 2 * jobs:
+                    break
+            if not pending:
+                break
+            chunk, result = pending.popleft()
+            counterparts, misses = result.get()
+            for i in misses:
+                counterparts[i] = _MISSING
+            for pair in zip(chunk, counterparts):
+                yield pair
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_mapping = None
+
+
+def _read_records(fp, separator, size=1 << 16):
+    """Yield the records in a binary file as they are read, without their
+    separators, keeping no more than one block in memory.  Records are
+    decoded as file names are, so that names that are not valid UTF-8
+    survive the trip.
+
+    """
+    separator = separator.encode("ascii")
+    if separator == b"\n":
+        for line in fp:
+            yield _fsdecode(line[:-1] if line.endswith(b"\n") else line)
+        return
+    tail = b""
+    while True:
+        block = fp.read(size)
+        if not block:
+            break
+        records = (tail + block).split(separator)
+        tail = records.pop()
+        for record in records:
+            yield _fsdecode(record)
+    if tail:
+        yield _fsdecode(tail)
+
+
+def _glob_matches(name, relpath, globs):
+    """:return: True if any of `globs` matches: those with a "/" are
+        matched against `relpath`, the others against `name`.
+
+    """
+    for glob in globs:
+        if fnmatch.fnmatchcase(relpath if "/" in glob else name, glob):
+            return True
+    return False
+
+
+def _walk_tree(top, includes=(), excludes=(), prune=None):
+    """Yield the path of every entry in the tree under `top` (but not
+    `top` itself), in the order find(1) would, each directory's entries
+    sorted by name.  Symbolic links to directories are not followed.
+
+    :param includes: Globs (see _glob_matches); if any are given, only
+        paths matching one of them are yielded.
+    :param excludes: Globs for paths to skip, and directories not to
+        look into.
+    :param prune: Function called with the path of each directory; if
+        it returns True, nothing below that directory is visited.
+
+    """
+    scandir = getattr(os, "scandir", None)
+
+    def entries(directory, rel_directory):
+        try:
+            if scandir is not None:
+                found = [(entry.name, entry.is_dir(follow_symlinks=False))
+                         for entry in scandir(directory)]
+            else:
+                found = [(name, os.path.isdir(path) and
+                          not os.path.islink(path))
+                         for name, path in [(name, os.path.join(directory,
+                                                                name))
+                                            for name in os.listdir(
+                                                directory)]]
+        except OSError as exc:
+            sys.stderr.write("# Cannot read directory %s: %s\n" %
+                             (directory, exc))
+            return
+        for name, is_dir in sorted(found):
+            yield (name, is_dir, os.path.join(directory, name),
+                   os.path.join(rel_directory, name))
+
+    stack = [entries(top, "")]
+    while stack:
+        for name, is_dir, path, rel_path in stack[-1]:
+            if excludes and _glob_matches(name, rel_path, excludes):
+                continue
+            if not includes or _glob_matches(name, rel_path, includes):
+                yield path
+            if is_dir and not (prune and prune(path)):
+                stack.append(entries(path, rel_path))
+                break
+        else:
+            stack.pop()
+
+
+def _subtree_pruner(mapping):
+    """:return: A function telling whether no path below a directory can
+        have a counterpart in `mapping`, or None if that cannot be told
+        (with COUNTERPART_PATTERN rules or `prepend_path`, any path might
+        have one).
+
+    """
+    frozen = mapping.freeze()
+    if (frozen._prepend is not _MISSING or
+            frozen._prepend_error is not None or
+            frozen._pattern_matcher.rules):
+        return None
+    prefix_trie = frozen._prefix_trie
+    ancestors = set()
+    for key in ([known for known, __ in frozen._items()] +
+                list(prefix_trie.rules)):
+        components = [c.lower() for c in _PrefixTrie._components(key)]
+        for depth in range(1, len(components)):
+            ancestors.add(tuple(components[:depth]))
+
+    def prune(directory):
+        components = tuple(c.lower() for c in
+                           _PrefixTrie._components(directory))
+        return (components not in ancestors and
+                prefix_trie.match(directory) is _MISSING)
+
+    return prune
+
+
+def _counterpart_exists(counterpart):
+
+    return counterpart is not None and os.path.exists(counterpart)
+
+
+def _filter_by_existence(pairs, exists, chunk_size=256, threads=16):
+    """Yield only the (string, counterpart) pairs whose counterpart does
+    (or, if not `exists`, does not) exist, stat()ing `chunk_size` of
+    them at a time with a pool of threads.  Pairs without a counterpart
+    are passed on as they are.
+
+    """
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(threads)
+        pool_map = pool.map
+    except ImportError:
+        pool, pool_map = None, map
+    try:
+        for chunk in _chunked(pairs, chunk_size):
+            found = iter(pool_map(_counterpart_exists,
+                                  [counterpart for __, counterpart in chunk
+                                   if counterpart is not _MISSING]))
+            for string, counterpart in chunk:
+                if (counterpart is _MISSING or
+                        next(found) == bool(exists)):
+                    yield string, counterpart
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def compare_files(path, counterpart, chunk_size=1 << 20):
+    """Compare the contents of two files: first their sizes (and whether
+    they are one and the same file), then, only if that does not settle
+    it, their bytes, memory-mapped and compared a chunk at a time up to
+    the first difference.  (Equal mtimes are no proof of equal contents,
+    so they are not taken as one.)
+
+    :return: "identical", "differing", "missing" if either file does
+        not exist, or "directory" if both are directories (whose
+        contents are not compared).
+
+    """
+    try:
+        st_path = os.stat(path)
+        st_counterpart = os.stat(counterpart)
+    except (OSError, TypeError):
+        return "missing"
+    if ((st_path.st_dev, st_path.st_ino) ==
+            (st_counterpart.st_dev, st_counterpart.st_ino)):
+        return "identical"
+    if not (stat.S_ISREG(st_path.st_mode) and
+            stat.S_ISREG(st_counterpart.st_mode)):
+        return ("directory" if stat.S_ISDIR(st_path.st_mode) and
+                stat.S_ISDIR(st_counterpart.st_mode) else "differing")
+    if st_path.st_size != st_counterpart.st_size:
+        return "differing"
+    if st_path.st_size == 0:
+        return "identical"
+    maps = []
+    try:
+        for name in [path, counterpart]:
+            with open(name, "rb") as fp:
+                maps.append(mmap.mmap(fp.fileno(), 0,
+                                      access=mmap.ACCESS_READ))
+        mm_path, mm_counterpart = maps
+        if len(mm_path) != len(mm_counterpart):
+            return "differing"      # changed since the stat() calls
+        for offset in range(0, len(mm_path), chunk_size):
+            if (mm_path[offset:offset + chunk_size] !=
+                    mm_counterpart[offset:offset + chunk_size]):
+                return "differing"
+        return "identical"
+    except (IOError, OSError, ValueError):
+        return "missing"
+    finally:
+        for mm in maps:
+            mm.close()
+
+
+def _compare_pairs(pairs, threads=8):
+    """Compare each (string, counterpart) pair's files with compare_files()
+    in a pool of threads, yielding (string, counterpart, result) as
+    each comparison finishes, rather than in input order.  Pairs with
+    no counterpart come out at once, with a result of None.
+
+    """
+    try:
+        from concurrent.futures import (ThreadPoolExecutor, wait,
+                                        FIRST_COMPLETED)
+    except ImportError:
+        for string, counterpart in pairs:
+            yield (string, counterpart, None if counterpart is _MISSING
+                   else compare_files(string, counterpart))
+        return
+
+    def compare(string, counterpart):
+        return string, counterpart, compare_files(string, counterpart)
+
+    pool = ThreadPoolExecutor(threads)
+    pending = set()
+    try:
+        for string, counterpart in pairs:
+            if counterpart is _MISSING:
+                yield string, counterpart, None
+                continue
+            pending.add(pool.submit(compare, string, counterpart))
+            if len(pending) >= 4 * threads:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                done = [future for future in pending if future.done()]
+                pending.difference_update(done)
+            for future in done:
+                yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        pool.shutdown()
+
+
 def _generate_input(options):
-    """First send strings from any given file, one string per line, sends
-    any strings provided on the command line.
+    """First send strings from any given file, one string per line (or
+    NUL-terminated, with options.null), then sends any strings provided
+    on the command line.
 
     :param options: ArgumentParser or equivalent to provide
         options.input and options.strings.
@@ -268,19 +2817,98 @@ def _generate_input(options):
 
     """
     if options.input:
-        fp = open(options.input) if options.input != "-" else sys.stdin
-        for string in fp.readlines():
-            yield string
+        separator = "\0" if getattr(options, "null", False) else "\n"
+        if options.input == "-":
+            for string in _read_records(getattr(sys.stdin, "buffer",
+                                                sys.stdin), separator):
+                yield string
+        else:
+            with open(options.input, "rb", 1 << 16) as fp:
+                for string in _read_records(fp, separator):
+                    yield string
     if options.strings:
         for string in options.strings:
             yield string
 
 
-def main(argv=sys.argv):
+def _exported_shell(options, load_mapping):
+    """:return: What export_counterpart_shell() writes for the command's
+        options; kept in the parse cache (unless --no-cache) and made
+        again only when a config file has changed.
 
-    logger.debug("Invoked as %s from %s", argv[0], os.getcwd())
+    """
+    file_list = [os.path.abspath(options.config_file),
+                 os.path.join(os.getenv('HOME'),
+                              ConfigFromFile.rc_file_basename),
+                 [options.export_shell, options.else_action,
+                  options.else_errno, options.profile]]
+    parse_cache = None if options.no_cache else _ParseCache()
+    if parse_cache is not None:
+        text, __ = parse_cache.get("shell", file_list)
+        if text is not None:
+            return text
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    mapping = load_mapping()
+    output = StringIO()
+    export_counterpart_shell(mapping, output, options.export_shell,
+                             options.else_action, options.else_errno,
+                             options.config_file)
+    text = output.getvalue()
+    if parse_cache is not None:
+        parse_cache.put("shell", file_list,
+                        _file_signature(mapping.source_files), text)
+    return text
+
+
+class _Options:
+    """Parsed command-line options, as argparse would give them."""
+
+    def __init__(self, **options):
+
+        self.__dict__.update(options)
+
+
+def _default_options():
+    """:return: dict of the value of every option of the counterpart
+        command when it is not given (kept equal to what
+        _argument_parser() sets up).
+
+    """
+    return dict(else_action=None, compare=False, compile=None, dump=None,
+                else_errno=1, explain_includes=False, export_shell=None,
+                frozen=False,
+                no_cache=False, include=[], exclude=[], input=None,
+                jobs=1, log_config=os.getenv("COUNTERPART_LOG_CONFIG"),
+                no_newline=False, only_existing=False, only_missing=False,
+                null=False, stats=False, tsv=False, profile=None,
+                reverse=False,
+                serve=False, socket=None, walk=None, strings=[],
+                config_file=ConfigFromFile.rc_file_basename)
+
+
+def _parse_args(args):
+    """Parse the command line.  The common case of only strings to look
+    up (no options) is handled without argparse, which takes longer to
+    import and set up than such a lookup takes.
+
+    :return: The options, as attributes.
+
+    """
+    if args and not [arg for arg in args if arg.startswith("-")]:
+        options = _default_options()
+        options["strings"] = list(args)
+        return _Options(**options)
+    return _argument_parser().parse_args(args)
+
+
+def _argument_parser():
+
+    import argparse
     parser = argparse.ArgumentParser(prog="counterpart")
-    parser.add_argument("-a", "--else-action", type=str, default="exception",
+    parser.add_argument("-a", "--else-action", type=str, default=None,
                         choices=["passthrough", "silent",
                                  "error", "exception"],
                         help=("Action if missing: " +
@@ -288,42 +2916,227 @@ def main(argv=sys.argv):
                               "\"silent\" echoes nothing.  " +
                               "\"error\" prints a message to stderr.  " +
                               "\"exception\" raises a KeyError.  " +
-                              "The default is \"%(default)s\"."))
+                              "The default is \"exception\" (with " +
+                              "--walk, to leave out entries without " +
+                              "a counterpart)."))
+    parser.add_argument("--compare", action="store_true",
+                        help=("Compare each input file with its " +
+                              "counterpart, outputting \"identical\", " +
+                              "\"differing\" or \"missing\", the file " +
+                              "and its counterpart, in the order the " +
+                              "comparisons finish.  Exit status is 1 " +
+                              "unless all are identical."))
+    parser.add_argument("--compile", default=None, metavar="INDEX_FILE",
+                        help=("Write the fully resolved mapping to an " +
+                              "index file, usable as the --config-file " +
+                              "of later runs, and exit."))
+    parser.add_argument("--dump", default=None, choices=["tsv", "json"],
+                        help=("Write every COUNTERPART_MAP entry, fully " +
+                              "resolved, to stdout as TSV or JSON (which " +
+                              "can be INCLUDEd or used as the " +
+                              "--config-file of later runs), and exit."))
     parser.add_argument("-e", "--else-errno", type=int, default=1,
                         help=("Return code when no mapping is found " +
                               "(default is 1; 0 == no error)"))
+    parser.add_argument("--explain-includes", action="store_true",
+                        help=("Show which config files are read, in " +
+                              "what order, and which file INCLUDEd " +
+                              "each, then exit."))
+    parser.add_argument("--export-shell", nargs="?", const="bash",
+                        default=None, choices=["bash", "zsh"],
+                        metavar="SHELL",
+                        help=("Write the mapping as bash (default) or " +
+                              "zsh code defining counterpart_lookup, " +
+                              "for `source <(counterpart --export-shell)`, " +
+                              "and exit.  -a and -e apply to its misses."))
+    parser.add_argument("--frozen", action="store_true",
+                        help=("Resolve the whole mapping before the first " +
+                              "lookup (faster for many input strings)."))
+    parser.add_argument("--no-cache", action="store_true",
+                        help=("Always parse the config files, rather " +
+                              "than reuse what an earlier run parsed."))
+    parser.add_argument("--include", action="append", default=[],
+                        metavar="GLOB",
+                        help=("With --walk, output only entries that " +
+                              "match GLOB (may be repeated).  A GLOB " +
+                              "with a '/' is matched against the path " +
+                              "below DIR, others against the name."))
+    parser.add_argument("--exclude", action="append", default=[],
+                        metavar="GLOB",
+                        help=("With --walk, skip entries (and whole " +
+                              "directories) that match GLOB."))
     parser.add_argument("-i", "--input", default=None,
                         metavar="INPUT_FILE",
                         help=("Take input strings from the given file " +
                               "or '-' for STDIN."))
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help=("Map input strings in N parallel processes; " +
+                              "output stays in input order."))
+    parser.add_argument("--log-config", metavar="LOGGING_CONFIG_FILE",
+                        default=os.getenv("COUNTERPART_LOG_CONFIG"),
+                        help=("Configure logging from the given file, " +
+                              "in logging.config.fileConfig() format " +
+                              "(default: $COUNTERPART_LOG_CONFIG, else " +
+                              "logging is left unconfigured)."))
     parser.add_argument("-n", "--no-newline", action="store_true",
                         help="Print output without a trailing newline.")
+    only = parser.add_mutually_exclusive_group()
+    only.add_argument("--only-existing", action="store_true",
+                      help="Output only counterparts that exist on disk.")
+    only.add_argument("--only-missing", action="store_true",
+                      help=("Output only counterparts that do not " +
+                            "exist on disk."))
+    parser.add_argument("-0", "--null", action="store_true",
+                        help=("Input from --input, and all output, is " +
+                              "NUL-terminated (as with find -print0)."))
+    parser.add_argument("--stats", action="store_true",
+                        help=("Print to stderr how long loading took and " +
+                              "how lookups were answered.  Lookups are " +
+                              "made in this process (not by a --serve " +
+                              "process), and those made by -j worker " +
+                              "processes are not counted."))
+    parser.add_argument("--tsv", action="store_true",
+                        help=("Output \"INPUT<TAB>COUNTERPART\" rather " +
+                              "than just the counterpart."))
     parser.add_argument("-V", "--version", action="version",
                         version="counterpart: Version %s" % (__version__),
                         help="Report version info and exit.")
+    parser.add_argument("-p", "--profile", default=None, metavar="NAME",
+                        help=("Use the sections of the named profile " +
+                              "(COUNTERPART_MAP:NAME and so on) rather " +
+                              "than the unnamed ones.  With --serve, the " +
+                              "server answers for that profile, and is " +
+                              "used only by commands given the same -p " +
+                              "(or none, if it was started without one)."))
+    parser.add_argument("-r", "--reverse", action="store_true",
+                        help=("Look up which string(s) map to each input " +
+                              "string, rather than its counterpart."))
+    parser.add_argument("--serve", action="store_true",
+                        help=("Keep the mapping loaded and answer " +
+                              "lookups from other counterpart commands " +
+                              "over a Unix socket (see --socket)."))
+    parser.add_argument("--socket", default=None, metavar="SOCKET_PATH",
+                        help=("Socket where a counterpart --serve process " +
+                              "listens; lookups go there when it serves " +
+                              "the same config.  (Default: " +
+                              "$COUNTERPART_SOCKET, else " +
+                              "$XDG_RUNTIME_DIR/counterpart-UID.sock)"))
+    parser.add_argument("-w", "--walk", default=None, metavar="DIR",
+                        help=("Map every file and directory under DIR, " +
+                              "outputting \"PATH<TAB>COUNTERPART\" pairs; " +
+                              "directories that nothing under could map " +
+                              "from are not visited."))
     parser.add_argument("strings", nargs="*")
     ConfigFromFile.register_options(parser)
-    options = parser.parse_args()
-    mapping = get_counterpart_mapping(options.config_file)
+    return parser
+
+
+def main(argv=sys.argv):
+
+    logger.debug("Invoked as %s from %s", argv[0], os.getcwd())
+    options = _parse_args(argv[1:])
+    try:
+        return _run_command(options)
+    except NoSuchProfile as exc:
+        sys.stderr.write("counterpart: %s\n" % (exc.args[0]))
+        return 2
+
+
+def _run_command(options):
+
+    if options.log_config:
+        import logging.config
+        logging.config.fileConfig(options.log_config,
+                                  disable_existing_loggers=False)
+    skip_misses = options.walk is not None and options.else_action is None
+    if options.else_action is None:
+        options.else_action = "exception"
+    if options.walk is not None and not options.compare:
+        options.tsv = True
+    socket_path = options.socket or default_socket_path()
+    stats = CounterpartStats() if options.stats else None
+
+    def load_mapping():
+        return get_counterpart_mapping(options.config_file,
+                                       frozen=options.frozen,
+                                       cache=not options.no_cache,
+                                       tracer=stats,
+                                       profile=options.profile)
+
+    if options.serve:
+        import counterparts_aio
+        return counterparts_aio.serve(socket_path, options.config_file,
+                                      profile=options.profile)
+    if options.compile:
+        compile_counterpart_index(load_mapping(), options.compile)
+        return 0
+    if options.dump:
+        dump_counterpart_mapping(load_mapping(), sys.stdout, options.dump)
+        return 0
+    if options.export_shell:
+        sys.stdout.write(_exported_shell(options, load_mapping))
+        return 0
+    if options.explain_includes:
+        if IndexedCounterpartMapping.is_index(options.config_file):
+            sys.stdout.write("%s  (compiled index)\n" % (options.config_file))
+        else:
+            sys.stdout.write(ConfigFromFile(options.config_file, [])
+                             .explain_includes())
+        return 0
+    mapping = None
+    strings = _generate_input(options)
+    if options.walk is not None:
+        mapping = load_mapping()
+        strings = _walk_tree(options.walk, options.include, options.exclude,
+                             _subtree_pruner(mapping) if skip_misses
+                             else None)
+    if options.reverse:
+        pairs = _map_reverse((mapping or load_mapping()).inverse(), strings)
+    elif options.jobs > 1:
+        pairs = _map_in_parallel(mapping or load_mapping(), strings,
+                                 options.jobs,
+                                 (options.config_file, False, options.frozen,
+                                  not options.no_cache, None, True,
+                                  options.profile))
+    else:
+        identity = _config_identity(options.config_file, False,
+                                    options.profile)
+        mapping = (mapping or stats is None and
+                   _ServerMapping.connect(socket_path, identity,
+                                          load_mapping) or
+                   load_mapping())
+        pairs = _map_serially(mapping, strings)
+    if options.only_existing or options.only_missing:
+        pairs = _filter_by_existence(pairs, options.only_existing)
+    if options.compare:
+        results = _compare_pairs(pairs)
+    else:
+        results = ((p, counterpart_string, None)
+                   for p, counterpart_string in pairs)
     rc_so_far = 0
-    for p in _generate_input(options):
-        try:
-            counterpart_string = mapping[p]
-            rc_so_far = counterpart_found(p, counterpart_string,
-                                          options, rc_so_far)
-        except KeyError:
-            rc_so_far = (1 if options.else_action == "silent" else
-                         no_counterpart_found(p, options,
-                                              rc_so_far))
+    output = _BufferedOutput(sys.stdout)
+    try:
+        for p, counterpart_string, compared in results:
+            if counterpart_string is _MISSING and skip_misses:
+                continue
+            if compared is not None:
+                rc_so_far = comparison_found(p, counterpart_string, compared,
+                                             options, rc_so_far, output)
+                # Comparisons can be slow; show each result at once.
+                output.flush()
+            elif counterpart_string is not _MISSING:
+                rc_so_far = counterpart_found(p, counterpart_string,
+                                              options, rc_so_far, output)
+            else:
+                rc_so_far = (1 if options.else_action == "silent" else
+                             no_counterpart_found(p, options,
+                                                  rc_so_far, output))
+    finally:
+        output.flush()
+        if stats is not None:
+            sys.stderr.write(stats.summary())
     return rc_so_far
 
 
 if __name__ == "__main__":
-    try:
-        logging.config.fileConfig(os.path.join(os.getenv('HOME'),
-                                               config_file_basename))
-        logger = logging.getLogger()
-    except config_parser.NoSectionError:
-        pass
-    rc = main()
-    sys.exit(rc)
+    sys.exit(main())
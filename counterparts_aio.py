@@ -0,0 +1,307 @@
+# -*- mode: python -*-
+"""
+    counterparts_aio
+    ________________
+
+    asyncio-based services built on the counterparts module, kept apart
+    from it so that plain lookups never pay for importing asyncio.
+
+    :copyright: (c) 2015 by Lionel D. Hummel
+    :license: GPLv2; see LICENSE.txt for more details.
+
+    For more info:  http://github.com/lionel/counterparts
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import sys
+
+import counterparts
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_NOT_FOUND = object()
+
+
+class ServerRunning(RuntimeError):
+    """Another server is already listening on the socket."""
+
+
+def _include_paths(from_file, text):
+    """:return: The files that `text` (read from `from_file`) INCLUDEs, or
+        [] if they cannot be told without the files read before it.
+
+    """
+    if text is None or "INCLUDE" not in text:
+        return []
+    parser = counterparts.ConfigParser(
+        defaults=counterparts.ConfigFromFile.shared_environ,
+        allow_no_value=True)
+    try:
+        parser.read_string(text, from_file)
+        paths = parser.get("INCLUDE", "paths")
+    except Exception:
+        return []
+    return [counterparts.ConfigFromFile.include_path(from_file, f.strip())
+            for f in paths.split("\n")]
+
+
+async def _read_config_files(paths):
+    """Read `paths`, and every file that they INCLUDE, in a thread pool:
+    all the files named in one INCLUDE section are read at once.
+
+    :return: dict of file texts by path, for ConfigFromFile's
+        file_contents.
+
+    """
+    loop = asyncio.get_running_loop()
+    contents = {}
+    while paths:
+        paths = [p for p in dict.fromkeys(paths)
+                 if p not in contents and not counterparts._is_bulk_source(p)]
+        texts = await asyncio.gather(*[
+            loop.run_in_executor(None, counterparts._read_text, path)
+            for path in paths])
+        contents.update(zip(paths, texts))
+        paths = [include for path, text in zip(paths, texts)
+                 for include in _include_paths(path, text)]
+    return contents
+
+
+async def get_counterpart_mapping(config_file=None, skip_home=False,
+                                  frozen=False, profile=None):
+    """Like counterparts.get_counterpart_mapping, but without blocking
+    the event loop:  the config files are read in a thread pool, those
+    INCLUDEd together concurrently, and then parsed in the pool too.
+
+    The files are parsed just as the synchronous version parses them,
+    in the same order, so the mapping is the same.  (Should an INCLUDE
+    path depend on a variable from an earlier file, that include is
+    not read ahead, and is instead read as it is parsed.)
+
+    """
+    loop = asyncio.get_running_loop()
+    if config_file and await loop.run_in_executor(
+            None, counterparts.IndexedCounterpartMapping.is_index,
+            config_file):
+        mapping = await loop.run_in_executor(
+            None, counterparts.IndexedCounterpartMapping, config_file)
+        return mapping.profile(profile) if profile else mapping
+    home_rc_file = os.path.join(os.getenv('HOME'),
+                                counterparts.ConfigFromFile.rc_file_basename)
+    file_skip_list = [home_rc_file] if skip_home else []
+    local_rc_file = (config_file or
+                     counterparts.ConfigFromFile.rc_file_basename)
+    contents = await _read_config_files(
+        [f for f in [home_rc_file, local_rc_file]
+         if f not in file_skip_list])
+
+    def load():
+        config = counterparts.ConfigFromFile(config_file, [],
+                                             skip_file_read=file_skip_list,
+                                             file_contents=contents)
+        mapping = counterparts.CounterpartMapping(
+            map_config=config._parser, bulk_table=config.bulk_table,
+            profile=profile)
+        mapping.source_files = [path for path, __, __ in
+                                config.file_signature()]
+        return mapping.freeze() if frozen else mapping
+
+    return await loop.run_in_executor(None, load)
+
+
+async def map_counterpart(string, config_file=None, profile=None):
+    """Like counterparts.map_counterpart, without blocking the event loop.
+    """
+    mapping = await get_counterpart_mapping(config_file,
+                                            config_file is not None,
+                                            profile=profile)
+    return mapping[string]
+
+
+async def map_many(mapping, strings, default=None, chunk_size=256):
+    """Look up each of `strings`, an iterable or async iterable, in
+    `mapping`, yielding each counterpart (or `default`) in order as
+    soon as it is found.  Control goes back to the event loop at least
+    every `chunk_size` lookups, so a long batch never hogs it.
+
+    """
+    if not hasattr(strings, "__aiter__"):
+        for chunk in counterparts._chunked(strings, chunk_size):
+            for counterpart in mapping.map_many(chunk, default):
+                yield counterpart
+            await asyncio.sleep(0)
+        return
+    get = mapping.get
+    count = 0
+    async for known in strings:
+        yield get(known, default)
+        count += 1
+        if count % chunk_size == 0:
+            await asyncio.sleep(0)
+
+
+class CounterpartServer:
+    """Keeps one mapping loaded and answers lookups for counterpart
+    commands (see counterparts._ServerMapping for the protocol) on a
+    Unix socket.  The files the mapping came from are checked every
+    `check_interval` seconds, and the mapping is reloaded when any of
+    them has changed.  With `profile`, the mapping is that profile's
+    (see CounterpartMapping.profile()), and only clients asking for it
+    are answered.
+
+    """
+    def __init__(self, socket_path, config_file=None, skip_home=False,
+                 check_interval=1.0, profile=None):
+
+        self.socket_path = socket_path
+        self._config_file = config_file
+        self._skip_home = skip_home
+        self._profile = profile
+        self._identity = counterparts._config_identity(config_file,
+                                                       skip_home, profile)
+        self._check_interval = check_interval
+        self._stopping = None
+        self._writers = set()
+        self.mapping, self._signature = self._load()
+
+    def _load(self):
+
+        mapping = counterparts.get_counterpart_mapping(self._config_file,
+                                                       self._skip_home,
+                                                       frozen=True,
+                                                       profile=self._profile)
+        return mapping, counterparts._file_signature(mapping.source_files)
+
+    async def serve_forever(self):
+        """Listen until stop() is called."""
+        loop = asyncio.get_event_loop()
+        self._stopping = loop.create_future()
+        counterparts._private_socket_dir(self.socket_path)
+        self._remove_dead_socket()
+        server = await asyncio.start_unix_server(self._handle_client,
+                                                 path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        watcher = loop.create_task(self._watch_config())
+        logger.debug("serving %s on %s", self._identity, self.socket_path)
+        try:
+            await self._stopping
+        finally:
+            watcher.cancel()
+            server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await server.wait_closed()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def _remove_dead_socket(self):
+        """Remove a socket left behind by a server that is gone.
+
+        :raise ServerRunning: if a server still answers on it.
+
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except ConnectionRefusedError:
+            logger.debug("removing dead socket %s", self.socket_path)
+            os.remove(self.socket_path)
+            return
+        except FileNotFoundError:
+            return
+        finally:
+            sock.close()
+        raise ServerRunning("A server is already listening on %s" %
+                            (self.socket_path))
+
+    def stop(self):
+        """Make serve_forever() return; safe to call from any thread."""
+        loop = self._stopping.get_loop()
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(
+                lambda: (self._stopping.done() or
+                         self._stopping.set_result(None)))
+
+    async def _watch_config(self):
+
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self._check_interval)
+            signature = counterparts._file_signature(
+                [path for path, __, __ in self._signature])
+            if signature == self._signature:
+                continue
+            logger.debug("config changed; reloading")
+            try:
+                self.mapping, self._signature = await loop.run_in_executor(
+                    None, self._load)
+            except Exception as exc:
+                # Keep serving the last good mapping until the files
+                # are fixed.
+                logger.warning("reload failed, keeping old mapping: %s",
+                               exc)
+                self._signature = signature
+
+    async def _handle_client(self, reader, writer):
+
+        self._writers.add(writer)
+        try:
+            cwd = await self._read_record(reader)
+            identity = await self._read_record(reader)
+            if identity != self._identity:
+                writer.write(b"-\0")
+                return
+            writer.write(b"+\0")
+            while True:
+                known = await self._read_record(reader)
+                writer.write(self._answer(known, cwd).encode(
+                    "utf-8", "surrogateescape"))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _read_record(reader):
+
+        record = await reader.readuntil(b"\0")
+        return record[:-1].decode("utf-8", "surrogateescape")
+
+    def _answer(self, known, cwd):
+
+        try:
+            counterpart, = self.mapping.map_many([known], _NOT_FOUND, cwd)
+        except Exception as exc:
+            return "?%s\0" % (exc)
+        if counterpart is _NOT_FOUND:
+            return "!\0"
+        return "=%s\0" % (counterpart)
+
+
+def serve(socket_path, config_file=None, skip_home=False,
+          check_interval=1.0, profile=None):
+    """Run a CounterpartServer until interrupted.
+
+    :return: 0, or 1 if it could not listen on `socket_path` or there is
+        no such profile, for use as an exit status.
+
+    """
+    try:
+        server = CounterpartServer(socket_path, config_file, skip_home,
+                                   check_interval, profile)
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    except counterparts.NoSuchProfile as exc:
+        sys.stderr.write("counterpart: %s\n" % (exc.args[0]))
+        return 1
+    except (ServerRunning, IOError) as exc:
+        sys.stderr.write("counterpart: %s\n" % (exc))
+        return 1
+    return 0
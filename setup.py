@@ -20,7 +20,7 @@ setup(
     url='https://github.com/lionel/counterparts',
     packages=find_packages(),
     package_data={"tests": ["counterparts_data/conf-*"]},
-    py_modules=['counterparts'],
+    py_modules=['counterparts', 'counterparts_aio'],
     entry_points={
         "console_scripts": ["counterpart=counterparts:main"]
     },
@@ -1,9 +1,22 @@
 
 import unittest
+import io
 import os
+import re
+import sys
+import shutil
+import stat
+import tempfile
+import threading
+import time
 
 import counterparts
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 
 class MockOpts:
 
@@ -24,12 +37,36 @@ def under_src(p):
     return os.path.join(os.getenv("HOME"), "src/HummelAbode/src", p)
 
 
+def run_main(*args):
+    """Run the counterpart command in-process.
+
+    :return: (exit status, text written to stdout)
+
+    """
+    stdout_was = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        rc = counterparts.main(["counterpart"] + list(args))
+        return rc, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout_was
+
+
 class TestCounterparts(unittest.TestCase):
 
     def setUp(self):
 
-        # goes here
-        pass
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_home_was = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.tmp_dir, "cache")
+
+    def tearDown(self):
+
+        if self.cache_home_was is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.cache_home_was
+        shutil.rmtree(self.tmp_dir)
 
     def _conf_path(self, name):
 
@@ -71,6 +108,37 @@ class TestCounterparts(unittest.TestCase):
                           options.config_file,
                           skip_file_read=skip_files)
 
+    def test_conf_include_cycle(self):
+
+        with self.assertRaises(counterparts.RecursionInConfigFile) as cm:
+            counterparts.ConfigFromFile(self._conf_path("conf-cycle-a"))
+        self.assertTrue(re.search("conf-cycle-a -> .*conf-cycle-b -> "
+                                  ".*conf-cycle-a", str(cm.exception)),
+                        str(cm.exception))
+
+    def test_conf_include_diamond(self):
+
+        mapping = counterparts.get_counterpart_mapping(
+            self._conf_path("conf-diamond-0"), skip_home=True)
+        # Read in the order top, left, base, right; base is not read
+        # again for right:
+        self.assertEqual(mapping.map_many(["top", "left", "right",
+                                           "shared", "based"]),
+                         ["top", "left", "right", "base", "right"])
+        base = os.path.abspath(self._conf_path("conf-diamond-base"))
+        self.assertEqual(mapping.source_files.count(base), 1)
+        rc, output = run_main("--explain-includes",
+                              "-c", self._conf_path("conf-diamond-0"))
+        lines = output.split("\n")
+        self.assertEqual(rc, 0)
+        self.assertEqual(lines[1:], [
+            self._conf_path("conf-diamond-0"),
+            "  " + os.path.abspath(self._conf_path("conf-diamond-left")),
+            "    " + base,
+            "  " + os.path.abspath(self._conf_path("conf-diamond-right")),
+            "    " + base + "  (already read)",
+            ""])
+
     def test_conf_1_in_default(self):
         """Mappings come from COUNTERPART_MAP sections, not DEFAULT sections.
 
@@ -152,7 +220,7 @@ class TestCounterparts(unittest.TestCase):
 
     def test_conf_peer_dir(self):
 
-        if int(counterparts.py_major_str) >= 3:
+        if sys.version_info[0] >= 3:
             self.assertRaises(counterparts.config_parser.DuplicateOptionError,
                               self._read_mapping,
                               "conf-peer-0")
@@ -200,6 +268,1176 @@ class TestCounterparts(unittest.TestCase):
                          uniq_in_home)
         os.remove(uniq_in_home)
 
+    def test_conf_dir_prepend(self):
+
+        mapping = self._read_mapping("conf-dir-0")
+        self.assertEqual(mapping["foo"], under_home("bar"))
+        self.assertEqual(mapping["baz"], "../quux/baz")
+        self.assertEqual(mapping.get("baz"), "../quux/baz")
+
+    def test_get_default(self):
+
+        mapping = self._read_mapping("conf-2")
+        self.assertEqual(mapping.get("bashlib"), None)
+        self.assertEqual(mapping.get("bashlib", "nope"), "nope")
+        self.assertEqual(mapping.get("BashLib/Lib"), under_home("lib/bash"))
+
+    def test_frozen_matches_unfrozen(self):
+
+        for name, keys in [("conf-2", ["bashlib/bashlib", "BASHLIB/LIB",
+                                       "bashlib", "home"]),
+                           ("conf-1-overrides-default",
+                            ["counterpart", "from_default",
+                             "from_counterparts", "missing"]),
+                           ("conf-include-still-more",
+                            ["paths", "lib/bashpaths", "paths_ref", "src"]),
+                           ("conf-map-home", ["home", "HOME"]),
+                           ("conf-dir-0", ["foo", "baz", "/tmp/x/y"]),
+                           ("conf-1-in-default", ["counterpart"])]:
+            mapping = self._read_mapping(name)
+            frozen = mapping.freeze()
+            self.assertTrue(isinstance(frozen,
+                                       counterparts.FrozenCounterpartMapping))
+            for key in keys:
+                self.assertEqual(frozen.get(key, KeyError),
+                                 mapping.get(key, KeyError))
+
+    def test_frozen_via_get_counterpart_mapping(self):
+
+        mapping = counterparts.get_counterpart_mapping(
+            self._conf_path("conf-2"), skip_home=True, frozen=True)
+        self.assertTrue(isinstance(mapping,
+                                   counterparts.FrozenCounterpartMapping))
+        self.assertRaises(KeyError, mapping.__getitem__, "bashlib")
+        self.assertEqual(mapping["bashlib/lib_local"],
+                         under_home("lib/bash_local"))
+
+    def test_frozen_interpolation_cycle(self):
+
+        mapping = self._read_mapping("conf-interpolation-cycle").freeze()
+        self.assertEqual(mapping["fine"], "ok")
+        self.assertRaises(counterparts.config_parser.InterpolationDepthError,
+                          mapping.__getitem__, "chicken")
+        self.assertRaises(counterparts.config_parser.InterpolationDepthError,
+                          counterparts.compile_counterpart_index, mapping,
+                          os.path.join(self.tmp_dir, "cycle.idx"))
+
+    def test_compiled_index(self):
+
+        for name, keys in [("conf-2", ["bashlib/bashlib", "BASHLIB/LIB",
+                                       "bashlib", "home"]),
+                           ("conf-dir-0", ["foo", "baz", "/tmp/x/y"]),
+                           ("conf-include-still-more",
+                            ["paths", "lib/bashpaths", "paths_ref", "src"]),
+                           ("conf-1-in-default", ["counterpart"])]:
+            mapping = self._read_mapping(name)
+            index_path = os.path.join(self.tmp_dir, name + ".idx")
+            counterparts.compile_counterpart_index(mapping, index_path)
+            indexed = counterparts.get_counterpart_mapping(index_path)
+            self.assertTrue(isinstance(
+                indexed, counterparts.IndexedCounterpartMapping))
+            for key in keys:
+                self.assertEqual(indexed.get(key, KeyError),
+                                 mapping.get(key, KeyError))
+            self.assertEqual(sorted(indexed._map_items()),
+                             sorted(mapping.freeze()._map_items()))
+            indexed.close()
+
+    def test_compile_via_main(self):
+
+        index_path = os.path.join(self.tmp_dir, "conf-2.idx")
+        rc, output = run_main("-c", self._conf_path("conf-2"),
+                              "--compile", index_path)
+        self.assertEqual((rc, output), (0, ""))
+        rc, output = run_main("-c", index_path, "bashlib/lib")
+        self.assertEqual((rc, output), (0, under_home("lib/bash") + "\n"))
+
+    def test_parse_cache(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-cached")
+        include_path = os.path.join(self.tmp_dir, "conf-cached-include")
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        with open(conf_path, "w") as fp:
+            fp.write("[COUNTERPART_MAP]\nfoo = bar\n")
+
+        def load():
+            return counterparts.get_counterpart_mapping(conf_path,
+                                                        skip_home=True,
+                                                        cache=cache_dir)
+
+        self.assertEqual(load()["foo"], "bar")
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(load()["foo"], "bar")
+
+        # An edit, and then an added INCLUDE, are both noticed:
+        with open(include_path, "w") as fp:
+            fp.write("[COUNTERPART_MAP]\nbaz = quux\n")
+        with open(conf_path, "w") as fp:
+            fp.write("[COUNTERPART_MAP]\nfoo = barbar\n" +
+                     "[INCLUDE]\npaths = %s\n" % (include_path))
+        self.assertEqual(load()["foo"], "barbar")
+        self.assertEqual(load()["baz"], "quux")
+
+        # ...as is a change to the included file alone:
+        with open(include_path, "w") as fp:
+            fp.write("[COUNTERPART_MAP]\nbaz = quuxquux\n")
+        self.assertEqual(load()["baz"], "quuxquux")
+
+        # ...and its removal:
+        os.remove(include_path)
+        self.assertEqual(load().get("baz"), None)
+
+    def test_prefix_rules(self):
+
+        mapping = self._read_mapping("conf-prefix-0")
+        for m in [mapping, mapping.freeze()]:
+            # COUNTERPART_MAP comes first...
+            self.assertEqual(m["src/lisp/init.el"], under_home(".emacs"))
+            # ...then the longest matching prefix, by whole components...
+            self.assertEqual(m["src/lisp/Foo.el"],
+                             under_home("emacs/lisp/Foo.el"))
+            self.assertEqual(m["SRC/Lisp/other/x/Y.el"],
+                             under_home("emacs/lisp/vendor/x/Y.el"))
+            self.assertEqual(m["src/lisp"], under_home("emacs/lisp"))
+            self.assertEqual(m["/etc/site/a"], "/opt/site/etc/a")
+            self.assertEqual(m["/etc/x"], "/mnt/backup/etc/x")
+            # ...and prepend_path last.
+            self.assertEqual(m["src/lispy/a"], "elsewhere/src/lispy/a")
+            # DEFAULT options are not prefix rules:
+            self.assertEqual(m["home/x"], "elsewhere/home/x")
+
+    def test_prefix_rules_compiled(self):
+
+        index_path = os.path.join(self.tmp_dir, "conf-prefix-0.idx")
+        counterparts.compile_counterpart_index(
+            self._read_mapping("conf-prefix-0"), index_path)
+        mapping = counterparts.get_counterpart_mapping(index_path)
+        self.assertEqual(mapping["src/lisp/other/a.el"],
+                         under_home("emacs/lisp/vendor/a.el"))
+        mapping.close()
+
+    def test_map_many(self):
+
+        mapping = self._read_mapping("conf-2")
+        strings = ["bashlib/lib", "bashlib", "BASHLIB/LIB", "bashlib/lib"]
+        expected = [under_home("lib/bash"), "?", under_home("lib/bash"),
+                    under_home("lib/bash")]
+        for m in [mapping, mapping.freeze()]:
+            self.assertEqual(m.map_many(strings, default="?"), expected)
+            self.assertEqual(list(m.imap_many(iter(strings), default="?",
+                                              chunk_size=3)),
+                             expected)
+            self.assertEqual(m.map_many(strings)[1], None)
+            self.assertEqual(m.map_many([]), [])
+
+    def test_main_misses(self):
+
+        conf_path = self._conf_path("conf-2")
+        rc, output = run_main("-c", conf_path, "-a", "passthrough", "-e", "3",
+                              "bashlib/lib", "bashlib", "bashlib/bashlib")
+        self.assertEqual(rc, 3)
+        self.assertEqual(output, "\n".join([under_home("lib/bash"),
+                                            "bashlib",
+                                            under_home("lib/bashlib")]) +
+                         "\n")
+        rc, output = run_main("-c", conf_path, "-a", "silent", "bashlib")
+        self.assertEqual((rc, output), (1, ""))
+        self.assertRaises(KeyError, run_main, "-c", conf_path, "bashlib")
+
+    def test_main_input_file(self):
+
+        input_path = os.path.join(self.tmp_dir, "input")
+        with open(input_path, "w") as fp:
+            fp.write("bashlib/lib\nbashlib\nbashlib/bashlib")
+        rc, output = run_main("-c", self._conf_path("conf-2"),
+                              "-i", input_path, "-a", "passthrough",
+                              "--tsv", "bashlib/lib_local")
+        self.assertEqual(rc, 1)
+        self.assertEqual(output.split("\n"),
+                         ["bashlib/lib\t" + under_home("lib/bash"),
+                          "bashlib\tbashlib",
+                          "bashlib/bashlib\t" + under_home("lib/bashlib"),
+                          "bashlib/lib_local\t" +
+                          under_home("lib/bash_local"),
+                          ""])
+
+    def test_main_null_separated(self):
+
+        input_path = os.path.join(self.tmp_dir, "input")
+        with open(input_path, "w") as fp:
+            fp.write("bashlib/lib\0with\nnewline\0bashlib/bashlib\0")
+        rc, output = run_main("-c", self._conf_path("conf-2"),
+                              "-i", input_path, "-0", "-a", "passthrough")
+        self.assertEqual(rc, 1)
+        self.assertEqual(output, "\0".join([under_home("lib/bash"),
+                                            "with\nnewline",
+                                            under_home("lib/bashlib"),
+                                            ""]))
+
+    def test_main_valueless_option(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-valueless")
+        self._write(conf_path, "[COUNTERPART_MAP]\nbare\nfoo = bar\n")
+        self.assertEqual(run_main("-c", conf_path, "bare", "foo"),
+                         (0, "None\nbar\n"))
+        self.assertEqual(run_main("-c", conf_path, "--tsv", "bare"),
+                         (0, "bare\tNone\n"))
+
+    def test_main_blank_line(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-blank")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = bar\n" +
+                    "broken = %(missing)s\n" +
+                    "[COUNTERPART_DIR]\nprepend_path = /p\n")
+        stdin_was = sys.stdin
+        sys.stdin = io.TextIOWrapper(io.BytesIO(b"foo\n\nx/y\n"))
+        try:
+            self.assertEqual(run_main("-c", conf_path, "-i", "-"),
+                             (0, "bar\n/p/\n/p/x/y\n"))
+        finally:
+            sys.stdin = stdin_was
+        # A failing lookup does not lose those before it:
+        pairs = counterparts._map_serially(
+            counterparts.get_counterpart_mapping(conf_path, True),
+            ["foo", "x", "broken", "y"])
+        self.assertEqual(next(pairs), ("foo", "bar"))
+        self.assertEqual(next(pairs), ("x", "/p/x"))
+        self.assertRaises(Exception, next, pairs)
+
+    def test_main_null_separated_errors(self):
+
+        input_path = os.path.join(self.tmp_dir, "input")
+        with open(input_path, "w") as fp:
+            fp.write("bashlib/lib\0nothing\0")
+        stderr_was = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            rc, output = run_main("-c", self._conf_path("conf-2"),
+                                  "-i", input_path, "-0", "-a", "error")
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr_was
+        self.assertEqual((rc, output), (1, under_home("lib/bash") + "\0"))
+        self.assertEqual(errors, "# No counterpart found for: nothing\0")
+
+    def test_read_records_across_blocks(self):
+
+        fp = io.BytesIO(b"a\0bb\0ccc\0dddd")
+        self.assertEqual(list(counterparts._read_records(fp, "\0", size=3)),
+                         ["a", "bb", "ccc", "dddd"])
+
+    def test_main_undecodable_names(self):
+
+        if sys.version_info[0] < 3:
+            return
+        conf_path = os.path.join(self.tmp_dir, "conf-undecodable")
+        self._write(conf_path, "[COUNTERPART_PREFIX]\nsrc = dest\n")
+        input_path = os.path.join(self.tmp_dir, "input")
+        with open(input_path, "wb") as fp:
+            fp.write(b"src/caf\xe9.el\0src/ok.el\0")
+        for args, expected in [
+                (["-i", input_path, "-0"],
+                 b"dest/caf\xe9.el\0dest/ok.el\0"),
+                (["--tsv", os.fsdecode(b"src/\xff")],
+                 b"src/\xff\tdest/\xff\n")]:
+            stdout_was = sys.stdout
+            sys.stdout = io.TextIOWrapper(io.BytesIO(), "utf-8")
+            try:
+                rc = counterparts.main(["counterpart", "-c", conf_path] +
+                                       args)
+                sys.stdout.flush()
+                output = sys.stdout.buffer.getvalue()
+            finally:
+                sys.stdout = stdout_was
+            self.assertEqual((rc, output), (0, expected))
+
+    def _start_server(self, conf_path, check_interval=60, profile=None):
+
+        import counterparts_aio
+        import asyncio
+        socket_path = os.path.join(self.tmp_dir, "sock")
+        server = counterparts_aio.CounterpartServer(
+            socket_path, conf_path, check_interval=check_interval,
+            profile=profile)
+        thread = threading.Thread(
+            target=lambda: asyncio.run(server.serve_forever()))
+        thread.start()
+        server.thread = thread
+        self.addCleanup(thread.join)
+        self.addCleanup(lambda: server.stop())
+        deadline = time.time() + 10
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+        return server, socket_path
+
+    def _write(self, path, text):
+
+        with open(path, "w") as fp:
+            fp.write(text)
+
+    def test_server_lookups(self):
+
+        if sys.version_info[0] < 3:
+            return
+        conf_path = os.path.join(self.tmp_dir, "conf-served")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = served\n" +
+                    "[COUNTERPART_DIR]\nprepend_path = /p\n")
+        server, socket_path = self._start_server(conf_path)
+        # Change the file behind the server's back, so that answers
+        # from the server can be told apart from in-process lookups:
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = in-process\n")
+        rc, output = run_main("-c", conf_path, "--socket", socket_path,
+                              "--tsv", "foo", "FOO", "bar", "/abs")
+        self.assertEqual((rc, output.split("\n")),
+                         (0, ["foo\tserved", "FOO\tserved", "bar\t/p/bar",
+                              "/abs\t" + os.path.join(
+                                  "/p", os.path.relpath("/abs")), ""]))
+        # A client using another config does not use this server:
+        rc, output = run_main("-c", self._conf_path("conf-2"),
+                              "--socket", socket_path, "bashlib/lib")
+        self.assertEqual((rc, output), (0, under_home("lib/bash") + "\n"))
+        # Nor does anybody once it has stopped:
+        server.stop()
+        server.thread.join()
+        rc, output = run_main("-c", conf_path, "--socket", socket_path, "foo")
+        self.assertEqual((rc, output), (0, "in-process\n"))
+
+    def test_server_socket_checks(self):
+
+        if sys.version_info[0] < 3:
+            return
+        import counterparts_aio
+        import asyncio
+        import socket
+        conf_path = os.path.join(self.tmp_dir, "conf-served")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = served\n")
+        server, socket_path = self._start_server(conf_path)
+        # A second server does not take the socket over:
+        second = counterparts_aio.CounterpartServer(socket_path, conf_path)
+        self.assertRaises(counterparts_aio.ServerRunning, asyncio.run,
+                          second.serve_forever())
+        self.assertEqual(counterparts_aio.serve(socket_path, conf_path), 1)
+        self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+        # A client trusts only a server run by its own user:
+        getuid_was = os.getuid
+        os.getuid = lambda: getuid_was() + 1
+        try:
+            self._write(conf_path, "[COUNTERPART_MAP]\nfoo = in-process\n")
+            self.assertEqual(run_main("-c", conf_path, "--socket",
+                                      socket_path, "foo"),
+                             (0, "in-process\n"))
+        finally:
+            os.getuid = getuid_was
+        server.stop()
+        server.thread.join()
+        # ...but a socket left by a server that is gone is replaced:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.close()
+        second._remove_dead_socket()
+        self.assertFalse(os.path.exists(socket_path))
+        # The fallback socket directory must be the user's alone:
+        fallback_was = counterparts._fallback_socket_dir
+        private_dir = os.path.join(self.tmp_dir, "private")
+        counterparts._fallback_socket_dir = lambda: private_dir
+        try:
+            private_path = os.path.join(private_dir, "counterpart.sock")
+            counterparts._private_socket_dir(private_path)
+            self.assertEqual(stat.S_IMODE(os.stat(private_dir).st_mode),
+                             0o700)
+            os.chmod(private_dir, 0o777)
+            self.assertRaises(IOError, counterparts._private_socket_dir,
+                              private_path)
+        finally:
+            counterparts._fallback_socket_dir = fallback_was
+
+    def test_server_reloads(self):
+
+        if sys.version_info[0] < 3:
+            return
+        conf_path = os.path.join(self.tmp_dir, "conf-served")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = before\n")
+        server, socket_path = self._start_server(conf_path,
+                                                 check_interval=0.01)
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = after reload\n")
+        deadline = time.time() + 10
+        while (server.mapping.get("foo") != "after reload" and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(server.mapping.get("foo"), "after reload")
+
+    def test_main_jobs(self):
+
+        input_path = os.path.join(self.tmp_dir, "input")
+        with open(input_path, "w") as fp:
+            for i in range(10000):
+                fp.write("bashlib/lib\n" if i % 3 else "miss/%d\n" % (i))
+        conf_path = self._conf_path("conf-2")
+        serial = run_main("-c", conf_path, "-i", input_path,
+                          "-a", "passthrough", "-e", "5")
+        parallel = run_main("-c", conf_path, "-i", input_path,
+                            "-a", "passthrough", "-e", "5", "-j", "3")
+        self.assertEqual(serial[0], 5)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(parallel[1].splitlines()), 10000)
+        self.assertEqual(run_main("-c", conf_path, "-j", "2", "bashlib/lib"),
+                         (0, under_home("lib/bash") + "\n"))
+
+    def test_pattern_rules(self):
+
+        mapping = self._read_mapping("conf-pattern-0")
+        index_path = os.path.join(self.tmp_dir, "conf-pattern-0.idx")
+        counterparts.compile_counterpart_index(mapping, index_path)
+        indexed = counterparts.get_counterpart_mapping(index_path)
+        for m in [mapping, mapping.freeze(), indexed]:
+            for _ in range(2):      # the second time, from the cache
+                self.assertEqual(m["build-7/notes.txt"],
+                                 "notes-for-seven.txt")
+                self.assertEqual(m["build-12/Bin/x"], "release-12/Bin/x")
+                self.assertEqual(m["BUILD-12/y.orig"], "release-12/y.orig")
+                self.assertEqual(m["z.orig"], "z")
+                self.assertEqual(m["src/lisp/Foo.el"],
+                                 under_home("emacs/lisp/Foo.el"))
+                self.assertEqual(m["src/lisp/sub/bar.el"],
+                                 under_home("emacs/lisp/sub/bar.el"))
+                self.assertEqual(m["etc/baz.el"],
+                                 under_home("emacs/lisp/other/etc/baz.el"))
+                self.assertEqual(m["doc/x-b-intro.txt"],
+                                 "manual/x/-intro.txt")
+                self.assertEqual(m["src/doc/x-d.txt"], "source/doc/x-d.txt")
+                self.assertRaises(KeyError, m.__getitem__, "build-x/y")
+        indexed.close()
+
+    def test_pattern_backreferences(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-pattern-backref")
+        self._write(conf_path, "[COUNTERPART_PATTERN]\n" +
+                    "first = x(a)b -> first-\\1\n" +
+                    "twice = (x)(a)\\2 -> twice-\\1\n" +
+                    "named = (?P<n>[a-z]+)=(?P<m>[0-9]) -> named-\\g<m>\n" +
+                    "plain = ([a-z]+)-(\\d+) -> plain-\\2\n" +
+                    "again = (y)\\1-(?P<n>z) -> again-\\g<n>\n")
+        mapping = counterparts.get_counterpart_mapping(conf_path,
+                                                       skip_home=True)
+        for m in [mapping, mapping.freeze()]:
+            self.assertEqual(m["xab"], "first-a")
+            self.assertEqual(m["XAA"], "twice-X")
+            self.assertEqual(m["foo=1"], "named-1")
+            self.assertEqual(m["foo-12"], "plain-12")
+            self.assertEqual(m["yy-z"], "again-z")
+            self.assertRaises(KeyError, m.__getitem__, "xaa-")
+
+    def test_pattern_rules_as_written(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-pattern-case")
+        self._write(conf_path, "[COUNTERPART_PATTERN]\n" +
+                    "not-digits = v(\\D+) -> letters-\\1\n" +
+                    "colon = (?:a|b):(.*) -> colon-\\1\n" +
+                    "[COUNTERPART_GLOB]\n" +
+                    "equals = k=*.txt -> equals-\\1\n")
+        mapping = counterparts.get_counterpart_mapping(conf_path,
+                                                       skip_home=True)
+        self.assertEqual(mapping["vAbc"], "letters-Abc")
+        self.assertRaises(KeyError, mapping.__getitem__, "v12")
+        self.assertEqual(mapping["b:c"], "colon-c")
+        self.assertEqual(mapping["k=doc.txt"], "equals-doc")
+        # Rules that cannot be read are rejected when the rules are
+        # loaded (by a plain mapping, on its first lookup):
+        for section, rule in [("PATTERN", "bare"),
+                              ("PATTERN", "no-arrow = a(.*)"),
+                              ("PATTERN", "no-pattern = -> x"),
+                              ("PATTERN", "bad = a( -> x"),
+                              ("GLOB", "bare")]:
+            self._write(conf_path, "[COUNTERPART_%s]\n%s\n" %
+                        (section, rule))
+            self.assertRaises(ValueError,
+                              counterparts.get_counterpart_mapping,
+                              conf_path, True, frozen=True, shared=False)
+            mapping = counterparts.get_counterpart_mapping(conf_path, True,
+                                                           shared=False)
+            self.assertRaises(ValueError, mapping.get, "a")
+
+    def test_glob_to_regex(self):
+
+        for glob, matches, misses in [("*.el", ["a.el", "a/b.el"], ["a.elc"]),
+                                      ("?", ["a"], ["ab", ""]),
+                                      ("[!a]b", ["bb"], ["ab"]),
+                                      ("a+b[.]", ["a+b."], ["aab."])]:
+            regex = re.compile(counterparts._glob_to_regex(glob) + "\\Z")
+            for s in matches:
+                self.assertTrue(regex.match(s), (glob, s))
+            for s in misses:
+                self.assertFalse(regex.match(s), (glob, s))
+
+    def test_reloading_mapping(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-reloading")
+        include_path = os.path.join(self.tmp_dir, "conf-reloading-include")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = one\n")
+        mapping = counterparts.ReloadingCounterpartMapping(
+            conf_path, skip_home=True, check_interval=3600)
+        self.addCleanup(mapping.close)
+        self.assertEqual(mapping["foo"], "one")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = two\n" +
+                    "[INCLUDE]\npaths = %s\n" % (include_path))
+        self.assertEqual(mapping["foo"], "one")     # not checked yet
+        mapping.check_interval = 0
+        self.assertEqual(mapping["foo"], "two")
+        self.assertEqual(mapping.get("bar"), None)
+        self.assertTrue(include_path in mapping.source_files)
+        # Creating the (optional) include is noticed too:
+        self._write(include_path, "[COUNTERPART_MAP]\nbar = three\n")
+        self.assertEqual(mapping.map_many(["foo", "bar"]), ["two", "three"])
+        # A broken edit leaves the last good mapping in place:
+        self._write(conf_path, "[COUNTERPART_MAP\n")
+        self.assertEqual(mapping["bar"], "three")
+
+    def test_reloading_mapping_inotify(self):
+
+        class INotify:
+            """Stands in for inotify_simple.INotify; events are queued by
+            the test rather than by the kernel.
+
+            """
+            instances = []
+
+            def __init__(self):
+
+                self.watches = {}
+                self.events = []
+                self.closed = False
+                self.instances.append(self)
+
+            def add_watch(self, path, mask):
+
+                self.watches[path] = mask
+
+            def read(self, timeout=None):
+
+                events, self.events = self.events, []
+                return events
+
+            def close(self):
+
+                self.closed = True
+
+        class FakeModule:
+            pass
+
+        fake = FakeModule()
+        fake.INotify = INotify
+        module_was = sys.modules.get("inotify_simple")
+        sys.modules["inotify_simple"] = fake
+        try:
+            conf_path = os.path.join(self.tmp_dir, "conf-reloading")
+            self._write(conf_path, "[COUNTERPART_MAP]\nfoo = one\n")
+            mapping = counterparts.ReloadingCounterpartMapping(
+                conf_path, skip_home=True, check_interval=0)
+            self.addCleanup(mapping.close)
+            inotify, = INotify.instances
+            mask = inotify.watches[self.tmp_dir]
+            for flag in [0x8, 0x40, 0x80, 0x100, 0x200]:
+                self.assertTrue(mask & flag, hex(flag))
+            # Without an event, the files are not even looked at:
+            other_path = os.path.join(self.tmp_dir, "conf-other")
+            self._write(other_path, "[COUNTERPART_MAP]\nfoo = two\n")
+            os.remove(conf_path)
+            os.symlink(other_path, conf_path)
+            self.assertFalse(mapping._changed())
+            self.assertEqual(mapping["foo"], "one")
+            # IN_CREATE, as ln -s gives:
+            inotify.events.append(("create", conf_path))
+            self.assertEqual(mapping["foo"], "two")
+            # Reloading with the same directories keeps the watches:
+            self.assertEqual(len(INotify.instances), 1)
+            self.assertFalse(inotify.closed)
+        finally:
+            if module_was is None:
+                del sys.modules["inotify_simple"]
+            else:
+                sys.modules["inotify_simple"] = module_was
+
+    def test_reloading_mapping_threads(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-reloading")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = 0\nbar = 0\n")
+        mapping = counterparts.ReloadingCounterpartMapping(
+            conf_path, skip_home=True, check_interval=0)
+        self.addCleanup(mapping.close)
+        torn = []
+
+        def reader():
+            for __ in range(200):
+                foo, bar = mapping.mapping.map_many(["foo", "bar"])
+                if foo != bar:
+                    torn.append((foo, bar))
+
+        threads = [threading.Thread(target=reader) for __ in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(1, 20):
+            self._write(conf_path, "[COUNTERPART_MAP]\nfoo = %d\nbar = %d\n"
+                        % (i * 11, i * 11))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(torn, [])
+
+    def test_stats(self):
+
+        stats = counterparts.CounterpartStats()
+        mapping = counterparts.get_counterpart_mapping(
+            self._conf_path("conf-include-more"), skip_home=True,
+            tracer=stats)
+        self.assertEqual([depth for __, __, depth in stats.files],
+                         [0, 1, 2, 2])
+        self.assertTrue("parse" in stats.phases)
+        mapping.map_many(["lib/bashlib", "lib/bash", "nothing"])
+        self.assertEqual(mapping.get("LIB/BASH"), under_src("bashlib/lib"))
+        self.assertEqual(stats.hits, {"COUNTERPART_MAP": 3})
+        self.assertEqual(stats.misses, 1)
+        self.assertEqual(sum(stats.histogram), 4)
+        self.assertTrue("hit      COUNTERPART_MAP      3" in stats.summary())
+        # Frozen mappings report lookups the same way:
+        frozen = mapping.freeze()
+        frozen.get("lib/bash")
+        self.assertEqual(stats.hits, {"COUNTERPART_MAP": 4})
+        mapping.set_tracer(None)
+        mapping.get("lib/bash")
+        self.assertEqual(stats.hits, {"COUNTERPART_MAP": 4})
+
+    def test_stats_via_main(self):
+
+        stderr_was = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            rc, output = run_main("--stats", "--no-cache",
+                                  "-c", self._conf_path("conf-dir-0"),
+                                  "foo", "elsewhere")
+            summary = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr_was
+        self.assertEqual(rc, 0)
+        self.assertTrue("lookups: 2 " in summary, summary)
+        self.assertTrue("fallback COUNTERPART_DIR" in summary, summary)
+
+    def test_async_api(self):
+
+        if sys.version_info < (3, 7):
+            return
+        import asyncio
+        import counterparts_aio
+
+        async def strings():
+            for known in ["lib/bashlib", "nothing", "LIB/BASH"]:
+                await asyncio.sleep(0)
+                yield known
+
+        async def run():
+            conf_path = self._conf_path("conf-include-more")
+            mapping = await counterparts_aio.get_counterpart_mapping(
+                conf_path, skip_home=True, frozen=True)
+            expected = counterparts.get_counterpart_mapping(
+                conf_path, skip_home=True, frozen=True)
+            self.assertEqual(dict(mapping._map_items()),
+                             dict(expected._map_items()))
+            self.assertEqual(mapping.source_files, expected.source_files)
+            found = [c async for c in counterparts_aio.map_many(
+                mapping, strings(), "-")]
+            self.assertEqual(found, [under_src("bashlib"), "-",
+                                     under_src("bashlib/lib")])
+            found = [c async for c in counterparts_aio.map_many(
+                mapping, ["nothing", "lib/bashlib"], chunk_size=1)]
+            self.assertEqual(found, [None, under_src("bashlib")])
+            self.assertEqual(await counterparts_aio.map_counterpart(
+                "foo", self._conf_path("conf-dir-0")), under_home("bar"))
+            with self.assertRaises(counterparts.FileNotFound):
+                await counterparts_aio.get_counterpart_mapping(
+                    os.path.join(self.tmp_dir, "missing"))
+
+        asyncio.run(run())
+
+    def test_reverse(self):
+
+        mapping = counterparts.get_counterpart_mapping(
+            self._conf_path("conf-reverse-0"), skip_home=True)
+        inverse = mapping.inverse()
+        self.assertTrue(mapping.inverse() is inverse)
+        self.assertEqual(inverse.collisions(),
+                         {under_home(".emacs"): [".emacs",
+                                                 "lion-emacs-init.el"]})
+        self.assertRaises(counterparts.AmbiguousCounterpart,
+                          inverse.__getitem__, under_home(".emacs"))
+        self.assertEqual(sorted(inverse.originals(
+            under_home("emacs/lisp/x/y.el"))),
+            ["site/lisp/x/y.el", "src/lisp/x/y.el"])
+        # A string that COUNTERPART_MAP maps elsewhere is not an original:
+        self.assertEqual(inverse.originals(
+            under_home("emacs/lisp/shadowed.el")),
+            ["site/lisp/shadowed.el"])
+        self.assertEqual(inverse[under_home("other/a/b")], "a/b")
+        self.assertEqual(inverse.get("/nowhere"), None)
+        self.assertRaises(KeyError, inverse.__getitem__, "/nowhere")
+        for counterpart in [under_home("emacs/lisp/whence.el"),
+                            under_home("other/a/b")]:
+            for original in inverse.originals(counterpart):
+                self.assertEqual(mapping[original], counterpart)
+
+    def test_reverse_via_main(self):
+
+        stderr_was = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            rc, output = run_main("-r", "--tsv", "-a", "error",
+                                  "-c", self._conf_path("conf-reverse-0"),
+                                  under_home(".emacs"), "/nowhere")
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr_was
+        self.assertEqual(rc, 1)
+        self.assertEqual(output.split("\n"),
+                         [under_home(".emacs") + "\t.emacs",
+                          under_home(".emacs") + "\tlion-emacs-init.el", ""])
+        self.assertTrue("Several mappings to" in errors)
+        self.assertTrue("No counterpart found for: /nowhere" in errors)
+
+    def _make_tree(self):
+        """:return: (a tree of files to walk, config file for it, the
+            directory it maps src/lisp to)
+
+        """
+        top = os.path.join(self.tmp_dir, "tree")
+        dest = os.path.join(self.tmp_dir, "dest")
+        for path in ["src/lisp/foo.el", "src/lisp/init.el",
+                     "src/other/x.txt", "docs/readme", "dest/foo.el"]:
+            path = os.path.join(top if path[:5] != "dest/" else
+                                self.tmp_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self._write(path, "")
+        conf_path = os.path.join(self.tmp_dir, "conf-walk")
+        self._write(conf_path, "[COUNTERPART_MAP]\n%s/docs/readme = %s\n"
+                    % (top, os.path.join(dest, "readme")) +
+                    "[COUNTERPART_PREFIX]\n%s/src/lisp = %s\n" % (top, dest))
+        return top, conf_path, dest
+
+    def test_walk(self):
+
+        top, conf_path, dest = self._make_tree()
+        rc, output = run_main("--walk", top, "-c", conf_path)
+        self.assertEqual(rc, 0)
+        self.assertEqual(output.split("\n"), [
+            "%s/docs/readme\t%s/readme" % (top, dest),
+            "%s/src/lisp\t%s" % (top, dest),
+            "%s/src/lisp/foo.el\t%s/foo.el" % (top, dest),
+            "%s/src/lisp/init.el\t%s/init.el" % (top, dest), ""])
+        rc, output = run_main("--walk", top, "-c", conf_path,
+                              "--exclude", "docs", "--include", "*.el",
+                              "--only-existing")
+        self.assertEqual(output, "%s/src/lisp/foo.el\t%s/foo.el\n" %
+                         (top, dest))
+        rc, output = run_main("--walk", top, "-c", conf_path,
+                              "--include", "src/*", "--only-missing")
+        self.assertEqual(output.split("\n"), [
+            "%s/src/lisp/init.el\t%s/init.el" % (top, dest), ""])
+        rc, output = run_main("--walk", top, "-c", conf_path,
+                              "-a", "passthrough", "--include", "*.txt")
+        x_txt = os.path.join(top, "src/other/x.txt")
+        self.assertEqual((rc, output), (1, "%s\t%s\n" % (x_txt, x_txt)))
+
+    def test_walk_prunes(self):
+
+        top, conf_path, dest = self._make_tree()
+        mapping = counterparts.get_counterpart_mapping(conf_path, True)
+        prune = counterparts._subtree_pruner(mapping)
+        self.assertEqual([prune(os.path.join(top, d)) for d in
+                          ["src", "src/lisp", "src/lisp/sub", "src/other",
+                           "docs", "elsewhere"]],
+                         [False, False, False, True, False, True])
+        self.assertEqual(list(counterparts._walk_tree(top, prune=prune)),
+                         [os.path.join(top, p) for p in
+                          ["docs", "docs/readme", "src", "src/lisp",
+                           "src/lisp/foo.el", "src/lisp/init.el",
+                           "src/other"]])
+        # Any path might have a counterpart given prepend_path:
+        self.assertEqual(counterparts._subtree_pruner(
+            counterparts.get_counterpart_mapping(
+                self._conf_path("conf-dir-0"), True)), None)
+
+    def test_compare(self):
+
+        top, conf_path, dest = self._make_tree()
+        self._write(os.path.join(top, "src/lisp/foo.el"), "x" * 100000)
+        self._write(os.path.join(dest, "foo.el"), "x" * 100000)
+        self._write(os.path.join(top, "docs/readme"), "read me")
+        self._write(os.path.join(dest, "readme"), "read ME")
+        same, differ = [os.path.join(top, p) for p in
+                        ["src/lisp/foo.el", "docs/readme"]]
+        self.assertEqual(counterparts.compare_files(same, same), "identical")
+        self.assertEqual(counterparts.compare_files(
+            same, os.path.join(dest, "foo.el"), chunk_size=4096),
+            "identical")
+        self._write(os.path.join(dest, "foo.el"), "x" * 99999 + "y")
+        self.assertEqual(counterparts.compare_files(
+            same, os.path.join(dest, "foo.el"), chunk_size=4096),
+            "differing")
+        self._write(os.path.join(dest, "foo.el"), "x" * 100000)
+        rc, output = run_main("--compare", "--walk", top, "-c", conf_path,
+                              "--include", "*.el", "--include", "readme")
+        self.assertEqual(rc, 1)
+        self.assertEqual(sorted(output.split("\n")), sorted([
+            "identical\t%s\t%s/foo.el" % (same, dest),
+            "missing\t%s/src/lisp/init.el\t%s/init.el" % (top, dest),
+            "differing\t%s\t%s/readme" % (differ, dest), ""]))
+        rc, output = run_main("--compare", "-c", conf_path, same)
+        self.assertEqual((rc, output),
+                         (0, "identical\t%s\t%s/foo.el\n" % (same, dest)))
+        lisp_dir = os.path.join(top, "src/lisp")
+        self.assertEqual(counterparts.compare_files(lisp_dir, dest),
+                         "directory")
+        self.assertEqual(counterparts.compare_files(lisp_dir, same),
+                         "differing")
+        rc, output = run_main("--compare", "-c", conf_path, lisp_dir)
+        self.assertEqual((rc, output),
+                         (0, "directory\t%s\t%s\n" % (lisp_dir, dest)))
+
+    def test_mapping_registry(self):
+
+        registry = counterparts.mapping_registry
+        registry.invalidate()
+        conf_path = os.path.join(self.tmp_dir, "conf-registry")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = one\n")
+        hits, misses = registry.hits, registry.misses
+        self.assertEqual(counterparts.map_counterpart("foo", conf_path), "one")
+        first = counterparts.get_counterpart_mapping(conf_path, True)
+        second = counterparts.get_counterpart_mapping(conf_path, True)
+        self.assertTrue(second._map_config is first._map_config)
+        self.assertFalse(counterparts.get_counterpart_mapping(
+            conf_path, True, shared=False)._map_config is first._map_config)
+        # Each caller's tracer is its own:
+        stats = counterparts.CounterpartStats()
+        first.set_tracer(stats)
+        self.assertEqual(second["foo"], "one")
+        self.assertEqual(first["foo"], "one")
+        self.assertTrue(second.tracer is None)
+        self.assertEqual(sum(stats.hits.values()), 1)
+        self.assertEqual((registry.hits - hits, registry.misses - misses),
+                         (2, 1))
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = second\n")
+        self.assertEqual(counterparts.map_counterpart("foo", conf_path),
+                         "second")
+        self.assertEqual(registry.misses - misses, 2)
+        registry.invalidate(conf_path)
+        self.assertEqual(len(registry), 0)
+        results = []
+
+        def lookups():
+            for __ in range(50):
+                results.append(counterparts.map_counterpart("foo",
+                                                            conf_path))
+
+        threads = [threading.Thread(target=lookups) for __ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["second"] * 200)
+        self.assertEqual(len(registry), 1)
+        registry.invalidate()
+
+    def test_path_normalizer(self):
+
+        import random
+        rng = random.Random(0)
+        parts = ["a", "b", "tmp", "..", ".", "", "x.txt"]
+        here = os.getcwd()
+        for cwd in ["/", here, os.path.dirname(here)]:
+            normalizer = counterparts._PathNormalizer(cwd)
+            for __ in range(2000):
+                path = "/".join(rng.choice(parts)
+                                for __ in range(rng.randint(1, 5)))
+                path = rng.choice(["", "/", "//", cwd + "/"]) + path
+                if not path:
+                    self.assertRaises(ValueError, normalizer.relpath, path)
+                    continue
+                self.assertEqual(normalizer.relpath(path),
+                                 os.path.relpath(os.path.join(cwd, path),
+                                                 cwd), (cwd, path))
+        mapping = counterparts.get_counterpart_mapping(
+            self._conf_path("conf-dir-0"), True, frozen=True)
+        strings = ["baz", "/abs/baz", "a/../b", here, ".."]
+        self.assertEqual(mapping.map_many(strings),
+                         [os.path.join(mapping._prepend,
+                                       os.path.relpath(s)) for s in strings])
+
+    def test_bulk_sources(self):
+
+        mapping = self._read_mapping("conf-bulk-0")
+        self.assertEqual(mapping["tab\tname"], "new\nline")
+        self.assertEqual(mapping["plain"], "counterpart")
+        self.assertEqual(mapping["override"], "from-ini")
+        self.assertEqual(mapping["OVERRIDE"], "from-ini")
+        self.assertEqual(mapping["Mixed/Case.txt"], "mixed")
+        self.assertEqual(mapping["shared"], "from-json")
+        self.assertEqual(mapping["json-key"], "json value")
+        self.assertEqual(mapping.get("none-value", KeyError), None)
+        self.assertEqual(mapping.get("null", KeyError), None)
+        index_path = os.path.join(self.tmp_dir, "conf-bulk-0.idx")
+        self.assertEqual(
+            counterparts.compile_counterpart_index(mapping, index_path), 9)
+        indexed = counterparts.get_counterpart_mapping(index_path)
+        keys = ["tab\tname", "override", "Override", "shared", "missing",
+                "plain", "PLAIN", "Mixed/Case.txt", "mixed/case.txt"]
+        # Bulk entries are matched only in the case they were written:
+        for m in [mapping.freeze(), indexed]:
+            self.assertEqual([m.get(key, KeyError) for key in keys],
+                             [mapping.get(key, KeyError) for key in keys])
+        self.assertEqual(mapping.get("PLAIN"), None)
+        self.assertEqual(mapping.get("mixed/case.txt"), None)
+        self.assertEqual(sorted(indexed._bulk_items()),
+                         sorted(mapping.freeze()._bulk_items()))
+        indexed.close()
+
+        bad_path = os.path.join(self.tmp_dir, "bad.json")
+        with open(bad_path, "w") as fp:
+            fp.write('{"foo": ["bar"]}')
+        self.assertRaises(ValueError, counterparts.get_counterpart_mapping,
+                          bad_path, True)
+
+    def test_dump(self):
+
+        mapping = self._read_mapping("conf-bulk-0")
+        items = sorted(mapping.freeze()._items())
+        for dump_format in ["tsv", "json"]:
+            rc, output = run_main("-c", self._conf_path("conf-bulk-0"),
+                                  "--dump", dump_format)
+            self.assertEqual(rc, 0)
+            dump_path = os.path.join(self.tmp_dir, "dump." + dump_format)
+            with open(dump_path, "w") as fp:
+                fp.write(output)
+            reloaded = counterparts.get_counterpart_mapping(dump_path, True)
+            self.assertEqual(sorted(reloaded.freeze()._items()), items)
+            self.assertEqual(reloaded["tab\tname"], "new\nline")
+        self.assertRaises(counterparts.config_parser.InterpolationError,
+                          counterparts.dump_counterpart_mapping,
+                          self._read_mapping("conf-interpolation-cycle"),
+                          StringIO())
+
+    def test_fast_startup(self):
+
+        self.assertEqual(
+            counterparts._default_options(),
+            vars(counterparts._argument_parser().parse_args([])))
+        if sys.version_info < (3, 7):
+            return      # no -X importtime
+        with open(os.path.join(self.tmp_dir, ".counterc"), "w") as fp:
+            fp.write("[COUNTERPART_MAP]\nfoo = bar\n")
+        env = dict(os.environ, HOME=self.tmp_dir,
+                   COUNTERPART_SOCKET=os.path.join(self.tmp_dir, "sock"),
+                   PYTHONPATH=os.path.dirname(os.path.abspath(
+                       counterparts.__file__)))
+        env.pop("COUNTERPART_LOG_CONFIG", None)
+        import subprocess
+        process = subprocess.Popen(
+            [sys.executable, "-X", "importtime", "-c",
+             "import sys, counterparts; sys.exit(counterparts.main())",
+             "foo"], cwd=self.tmp_dir, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual((process.returncode, stdout), (0, b"bar\n"))
+        imported = set(re.findall(r"^import time:.*\| +(\S+)$",
+                                  stderr.decode("utf-8"), re.MULTILINE))
+        self.assertTrue("counterparts" in imported)
+        # A plain lookup needs none of these:
+        for module in ["argparse", "asyncio", "concurrent.futures",
+                       "hashlib", "logging.config", "multiprocessing",
+                       "platform", "socket"]:
+            self.assertFalse(module in imported, module)
+
+    def _run_exported_shell(self, conf_name, strings, *args):
+        """Source `counterpart --export-shell` for conf_name in bash and
+        look each of `strings` up with counterpart_lookup.
+
+        :return: list of (output, status), one per string.
+
+        """
+        import subprocess
+        bin_dir = os.path.join(self.tmp_dir, "bin")
+        if not os.path.isdir(bin_dir):
+            os.mkdir(bin_dir)
+            # For the strings that the exported code hands back to the
+            # counterpart command:
+            self._write(os.path.join(bin_dir, "counterpart"),
+                        "#!/bin/sh\nexec %s -c 'import sys, counterparts; "
+                        "sys.exit(counterparts.main())' \"$@\"\n" %
+                        (sys.executable))
+            os.chmod(os.path.join(bin_dir, "counterpart"), 0o755)
+        rc, code = run_main("-c", self._conf_path(conf_name),
+                            "--export-shell", *args)
+        self.assertEqual(rc, 0)
+        script = code + "".join(
+            "counterpart_lookup %s 2>&1; echo \"<$?>\"\n" %
+            (counterparts._shell_quote(string))
+            for string in strings)
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"],
+                   COUNTERPART_SOCKET=os.path.join(self.tmp_dir, "sock"),
+                   PYTHONPATH=os.path.dirname(os.path.abspath(
+                       counterparts.__file__)))
+        process = subprocess.Popen(["bash", "-c", script], env=env,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0].decode("utf-8")
+        return re.findall(r"(.*?)\n?<(\d+)>\n", output, re.DOTALL)
+
+    def test_export_shell(self):
+
+        if (sys.version_info[0] < 3 or
+                not os.path.exists("/bin/bash")):
+            return
+        strings = ["src/lisp/init.el", "SRC/Lisp/foo.el", "src/lisp",
+                   "src/lisp/other/x/y.el", "/etc/site/conf", "/usr/bin/x",
+                   "plain/file", "a/../b", "/", "it's"]
+        mapping = self._read_mapping("conf-prefix-0")
+        self.assertEqual(self._run_exported_shell("conf-prefix-0", strings),
+                         [(mapping[string], "0") for string in strings])
+
+        # Pattern rules and misses:
+        strings = ["build-7/notes.txt", "build-8/x", "src/y", "z.orig",
+                   "none"]
+        mapping = self._read_mapping("conf-pattern-0")
+        self.assertEqual(
+            self._run_exported_shell("conf-pattern-0", strings,
+                                     "-a", "passthrough", "-e", "5"),
+            [(mapping[string], "0") for string in strings[:-1]] +
+            [("none", "5")])
+        self.assertEqual(
+            self._run_exported_shell("conf-2", ["nothing"], "-a", "error"),
+            [("# No counterpart found for: nothing", "1")])
+        self.assertEqual(
+            self._run_exported_shell("conf-2", ["nothing"], "-a", "silent"),
+            [("", "1")])
+        self.assertEqual(
+            self._run_exported_shell("conf-2", ["nothing"]),
+            [("KeyError: 'No counterpart found for: nothing'", "1")])
+
+        # Bulk entries, matched only in the case they were written:
+        self.assertEqual(
+            self._run_exported_shell("conf-bulk-0",
+                                     ["Mixed/Case.txt", "mixed/case.txt",
+                                      "OVERRIDE", "plain"], "-a", "silent"),
+            [("mixed", "0"), ("", "1"), ("from-ini", "0"),
+             ("counterpart", "0")])
+
+    def test_export_shell_cached(self):
+
+        conf_path = os.path.join(self.tmp_dir, "conf-exported")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = bar\n")
+        rc, code = run_main("-c", conf_path, "--export-shell", "zsh")
+        self.assertEqual(rc, 0)
+        self.assertTrue("    'foo' 'bar'\n" in code)
+        cache_dir = os.path.join(self.tmp_dir, "cache", "counterparts")
+        self.assertEqual(len([name for name in os.listdir(cache_dir)
+                              if name.startswith("shell-")]), 1)
+        self.assertEqual(run_main("-c", conf_path, "--export-shell", "zsh"),
+                         (0, code))
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = barbar\n")
+        rc, code = run_main("-c", conf_path, "--export-shell", "zsh")
+        self.assertTrue("    'foo' 'barbar'\n" in code)
+
+    def test_profiles(self):
+
+        conf_path = self._conf_path("conf-profile-0")
+        for frozen in [False, True]:
+            mapping = counterparts.get_counterpart_mapping(conf_path, True,
+                                                           frozen=frozen)
+            self.assertEqual(mapping.profiles(), ["prod", "staging"])
+            self.assertEqual(mapping["app.conf"], "/srv/dev/app.conf")
+            self.assertEqual(mapping["x"], "/srv/dev/x")
+            staging = mapping.profile("staging")
+            self.assertTrue(staging is mapping.profile("staging"))
+            self.assertTrue(staging.profile(None) is mapping)
+            self.assertEqual(staging["app.conf"], "/srv/staging/app.conf")
+            self.assertEqual(staging["lib/a"], "/srv/staging/lib/a")
+            self.assertRaises(KeyError, staging.__getitem__, "x")
+            prod = counterparts.get_counterpart_mapping(
+                conf_path, True, frozen=frozen, profile="prod")
+            self.assertEqual(prod["x"], "/srv/prod/x")
+            self.assertRaises(counterparts.config_parser.InterpolationError,
+                              prod.__getitem__, "broken")
+            self.assertRaises(KeyError, mapping.profile, "nope")
+        for frozen, cache in [(False, False), (True, False), (True, True)]:
+            self.assertRaises(counterparts.NoSuchProfile,
+                              counterparts.get_counterpart_mapping,
+                              conf_path, True, frozen=frozen, cache=cache,
+                              profile="prdo")
+
+        # Only the sections of the profile asked for are resolved:
+        resolved = []
+        resolve_section_was = counterparts._resolve_section
+
+        def resolve_section(sections, section, own_only=False):
+            resolved.append(section)
+            return resolve_section_was(sections, section, own_only)
+
+        counterparts._resolve_section = resolve_section
+        try:
+            mapping = counterparts.get_counterpart_mapping(
+                conf_path, True, frozen=True, shared=False,
+                profile="staging")
+        finally:
+            counterparts._resolve_section = resolve_section_was
+        self.assertEqual(mapping["app.conf"], "/srv/staging/app.conf")
+        self.assertEqual([section for section in resolved
+                          if not section.endswith(":staging")], [])
+
+    def test_profiles_via_main(self):
+
+        conf_path = self._conf_path("conf-profile-0")
+        self.assertEqual(run_main("-c", conf_path, "-p", "prod", "x"),
+                         (0, "/srv/prod/x\n"))
+        self.assertEqual(run_main("-c", conf_path, "x"),
+                         (0, "/srv/dev/x\n"))
+        index_path = os.path.join(self.tmp_dir, "staging.idx")
+        self.assertEqual(run_main("-c", conf_path, "--profile", "staging",
+                                  "--compile", index_path), (0, ""))
+        indexed = counterparts.get_counterpart_mapping(index_path)
+        self.assertEqual(indexed.profile_name, "staging")
+        self.assertEqual(indexed["lib/b"], "/srv/staging/lib/b")
+        self.assertRaises(KeyError, indexed.profile, "prod")
+        indexed.close()
+        stderr_was = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertEqual(run_main("-c", conf_path, "-p", "prdo", "x"),
+                             (2, ""))
+            self.assertEqual(sys.stderr.getvalue(),
+                             "counterpart: No such profile: prdo\n")
+        finally:
+            sys.stderr = stderr_was
+
+    def test_profile_served(self):
+
+        if sys.version_info[0] < 3:
+            return
+        import counterparts_aio
+        conf_path = os.path.join(self.tmp_dir, "conf-profile-served")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = dev\n" +
+                    "[COUNTERPART_MAP:prod]\nfoo = served\n")
+        socket_path = os.path.join(self.tmp_dir, "sock")
+        stderr_was = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertEqual(counterparts_aio.serve(socket_path, conf_path,
+                                                    profile="prdo"), 1)
+        finally:
+            sys.stderr = stderr_was
+        server, socket_path = self._start_server(conf_path, profile="prod")
+        self._write(conf_path, "[COUNTERPART_MAP]\nfoo = dev\n" +
+                    "[COUNTERPART_MAP:prod]\nfoo = in-process\n")
+        self.assertEqual(run_main("-c", conf_path, "--socket", socket_path,
+                                  "-p", "prod", "foo"), (0, "served\n"))
+        # A client not asking for that profile does not use the server:
+        self.assertEqual(run_main("-c", conf_path, "--socket", socket_path,
+                                  "foo"), (0, "dev\n"))
+
 
 if __name__ == "__main__":
 